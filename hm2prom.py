@@ -11,13 +11,40 @@ __email__ = "markus@relab.rocks"
 
 
 import xml.etree.ElementTree as ET
-import urllib.request
+import urllib.parse
+import http.client
+import concurrent.futures
+import queue
+import collections
+import hashlib
+import cProfile
+import pstats
+import tracemalloc
+import signal
+import io
+import glob
+import array
+import os
+import pickle
+import socket
+import xmlrpc.client
+import xmlrpc.server
 import time
+import random
 import traceback
 import importlib.util
 import sys
 #sys.path.append("./lib/client_python")     #provide local versions of libs if not provide by system via pip install
-from prometheus_client import start_http_server, Gauge
+import threading
+import http.server
+import socketserver
+import gzip
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, REGISTRY, CollectorRegistry
+from prometheus_client.exposition import generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.openmetrics.exposition import generate_latest as generate_latest_openmetrics
+from prometheus_client.openmetrics.exposition import CONTENT_TYPE_LATEST as CONTENT_TYPE_OPENMETRICS
+from prometheus_client.samples import Sample
 
 
 ##############DECLARATIONS#################################
@@ -30,12 +57,54 @@ from prometheus_client import start_http_server, Gauge
 
 # Generic Variable
 Homematic_CCU_URL="http://192.168.17.10"
-Interval=20  #Count in seconds between fetching results
+Homematic_CCU_Targets=[]  #List of CCU URLs for the multi CCU probe mode, they are exported on /probe?target=<url>. If empty only
+                          # Homematic_CCU_URL is exported on /metrics
+Interval=20  #Count in seconds between fetching results, the states are polled at this fixed rate while the CCU is healthy. This
+             # is the full sweep over statelist and sysvarlist, it can be raised if the datapoints which need a high resolution are hot
+Hot_Datapoints=[]  #ise_ids of datapoints which are polled every Hot_Interval via state.cgi in addition to the full sweep
+Hot_Channels=[]  #ise_ids of channels whose datapoints are all polled every Hot_Interval, e.g. power meters and window contacts
+Hot_Interval=2  #Count in seconds between polling the hot datapoints, lengthened in the same ratio as Interval while backing off
+Hot_Batch_Size=50  #Max number of datapoint ise_ids per state.cgi request, up to CCU_Max_Connections batches are fetched in parallel
+Interval_Max=300  #Upper bound in seconds of the poll interval when the CCU is slow or failing
+Poll_Latency_Threshold=5  #A poll of the states which takes longer than this count in seconds lengthens the interval
+Poll_Backoff_Factor=2  #Factor by which the interval grows per slow or failed poll and shrinks again per healthy poll
+Poll_Jitter=0.2  #Random share added to or removed from a lengthened interval, so several exporters do not retry in lockstep
 HTTP_Port=9110 #TCP port for prometheus metric exposure
+Render_TTL=Interval  #Max age in seconds of the rendered exposition, it is rerendered at least this often for the process metrics. The
+                     # CCU is never fetched on a scrape, the states are polled by the state_poller every Interval
+Topology_Interval=3600  #Count in seconds between refetching devices, rooms and functions to detect changes of the CCU topology
+CCU_Max_Connections=3  #Max number of parallel requests to a single CCU, the CCU has limited ressources
+Worker_Threads=8  #Number of worker threads which are shared by all CCUs for fetching the lists in parallel
+CCU_Timeout=15  #Timeout in seconds for connecting to the CCU and for every read on the connection
+Stream_Chunk_Size=65536  #Bytes read from the CCU response per step when the lists are parsed incrementally
+Snapshot_Directory="/var/lib/hm2prom"  #Directory for the on disk snapshot of topology and states per CCU, loaded on startup so the
+                                     # exporter serves immediately and revalidates against the CCU in the background. Empty disables
+                                     # it. hm2prom.sh creates the directory for DAEMON_USER with mode 700
+Snapshot_Save_Interval=300  #Count in seconds between writing the snapshot, it is also written after the topology changed
+Event_Interfaces=[]  #XML-RPC ports of the CCU interface processes hm2prom registers with for pushed events, e.g. [2001, 2010] for
+                    # BidCos-RF and HmIP-RF. The statelist is then only needed for reconciliation and Interval can be raised. Empty disables
+Event_Port=9111  #TCP port of the XML-RPC callback server which receives the events
+Event_Callback_Host=""  #Host name or IP under which the CCU reaches the callback server, if empty the local IP towards the CCU is used
+Event_Reinit_Interval=600  #Count in seconds between renewing the registration, the CCU drops callbacks which were unreachable
+Aggregation_Window=0  #Count in seconds over which hm2prom_states_min, _max and the time weighted _avg are exported, usually the scrape
+                      # interval, so changes between two scrapes (e.g. by hot polling or events) are not lost. 0 disables the aggregation
+Aggregation_Ring_Size=32  #Number of value changes per datapoint kept for the aggregation, older changes within the window are dropped
+Profile_Cycles=3  #Number of poll cycles profiled with cProfile and tracemalloc after SIGUSR1 or /debug/profile
+Profile_Directory="/tmp"  #Directory for the profiler reports hm2prom_profile_<time>.txt and the matching .pstats file
+Debug_Endpoints=False  #If True /debug/profile?cycles=<n> starts the cycle profiler
+Record_Directory=""  #If set every raw xmlapi response is saved to <directory>/<ccu host>/<endpoint>.<sequence>.xml for a later replay
+Record_Limit=100  #Max number of recorded responses per xmlapi path, further responses are not recorded
+Replay_Directory=""  #If set the xmlapi responses are read from a Record_Directory instead of the CCU, the recorded responses of a
+                    # path are returned in order and start over after the last one
+Replay_Cycles=0  #If >0 with Replay_Directory, hm2prom runs this many poll cycles back to back, prints their durations and exits
+Replay_Profile=False  #Profile the cycles of Replay_Cycles with the cycle profiler
+Compact_Labels=False  #If True hm2prom_states only carries the datapoint labels (ise_id, name, type, valuetype, unit) and channel_iseid,
+                      # the channel and device metadata is exported once per channel and device in hm2prom_channel_info and
+                      # hm2prom_device_info. This shrinks the exposition, but rooms, functions and names need a PromQL join.
 
 # Declaration for prometheus state metrics (hm2prom_states) the labels have to be declared
-# here and get filled in the main function
-hm2prom_states = Gauge('hm2prom_states', 'Homematic export metrics', [
+# here and get filled by the HomematicCollector
+HM2PROM_STATES_LABELS = [
     'datapoint_ise_id',
     'datapoint_name',
     'datapoint_type',
@@ -52,38 +121,71 @@ hm2prom_states = Gauge('hm2prom_states', 'Homematic export metrics', [
     'parent_device_ise_id',
     'parent_device_address',
     'parent_device_name',
-    'parent_device_type'])
+    'parent_device_type']
+
+
+# Labels of hm2prom_states, hm2prom_channel_info and hm2prom_device_info for Compact_Labels. The info metrics have the value 1 and
+#  can be joined in PromQL e.g. hm2prom_states * on(channel_iseid) group_left(channel_name, channel_rooms) hm2prom_channel_info
+#  The datapoint labels stay on hm2prom_states, the unit and types are only known per datapoint and no info metric carries them.
+HM2PROM_STATES_COMPACT_LABELS = [
+    'datapoint_ise_id',
+    'channel_iseid',
+    'datapoint_name',
+    'datapoint_type',
+    'datapoint_value_type',
+    'datapoint_value_unit']
+
+HM2PROM_CHANNEL_INFO_LABELS = [
+    'channel_iseid',
+    'channel_address',
+    'channel_name',
+    'channel_type',
+    'channel_direction',
+    'channel_rooms',
+    'channel_functions',
+    'parent_device_ise_id']
+
+HM2PROM_DEVICE_INFO_LABELS = [
+    'parent_device_ise_id',
+    'parent_device_address',
+    'parent_device_name',
+    'parent_device_type']
 
 
 # Declaration for prometheus sysvar metrics (hm2prom_sysvar) the labels have to be declared here
-#  and get filled in the main function
-hm2prom_sysvar = Gauge('hm2prom_sysvar', 'Homematic export sysvar', [
+#  and get filled by the HomematicCollector
+HM2PROM_SYSVAR_LABELS = [
     'sysvar_ise_id',
     'sysvar_name',
     'sysvar_type',
     'sysvar_value_list',
-    'sysvar_value_unit',
-    'sysvar_value_string'])     # This field is used if a value contains alphanumerich characters. Prometheus doesn´t support non numeric values so this
-                                # values get transformed to a label and are written in this field.
-
+    'sysvar_value_unit']     # String sysvars have no numeric value, only hm2prom_sysvar_last_change_seconds is exported for them
 
 
-
-# Declaration for prometheus rssi RX (receive radio strength  of devices)  metrics (hm2prom_rssi_rx) the labels have to be declared
-#  here and get filled in the main function
-hm2prom_rssi_rx = Gauge('hm2prom_rssi_rx', 'Homematic export rssi (receive) radio strength', [
-    'rssi_address',
-    'rssi_devicename',
-    'rssi_room',
-    'rssi_direction'])
-
-# Declaration for prometheus rssi TX (sendig radio strength  of devices)  metrics (hm2prom_rssi_tx) the labels have to be declared
-#  here and get filled in the main function
-hm2prom_rssi_tx = Gauge('hm2prom_rssi_tx', 'Homematic export rssi (receive) radio strength', [
+# Declaration for prometheus rssi RX (hm2prom_rssi_rx) and TX (hm2prom_rssi_tx) radio strength metrics of devices the labels
+#  have to be declared here and get filled by the HomematicCollector
+HM2PROM_RSSI_LABELS = [
     'rssi_address',
     'rssi_devicename',
     'rssi_room',
-    'rssi_direction'])
+    'rssi_direction']
+
+# Self instrumentation of the poll pipeline, exported on /metrics
+FETCH_BUCKETS = (.05, .1, .25, .5, 1, 2.5, 5, 10, 20, 30)
+hm2prom_fetch_duration = Histogram('hm2prom_fetch_duration_seconds', 'Duration of fetching and parsing a xmlapi list from the CCU',
+    ['ccu', 'endpoint'], buckets=FETCH_BUCKETS)
+hm2prom_fetch_bytes = Counter('hm2prom_fetch_bytes', 'Bytes received from the CCU xmlapi', ['ccu', 'endpoint'])
+hm2prom_parse_duration = Histogram('hm2prom_parse_duration_seconds', 'Time spent parsing a xmlapi list without waiting for the CCU',
+    ['ccu', 'endpoint'], buckets=FETCH_BUCKETS)
+hm2prom_update_duration = Histogram('hm2prom_update_duration_seconds', 'Time spent building labels and samples out of the fetched lists per cycle',
+    ['ccu'], buckets=FETCH_BUCKETS)
+hm2prom_series = Gauge('hm2prom_series', 'Number of series exported per metric family', ['ccu', 'family'])
+hm2prom_errors = Counter('hm2prom_errors', 'Errors in the poll pipeline by type (fetch, xml_parsing, value_conversion, topology, event_registration)', ['ccu', 'type'])
+hm2prom_events = Counter('hm2prom_events', 'Datapoint events pushed by the CCU via XML-RPC', ['ccu'])
+hm2prom_poll_duration = Histogram('hm2prom_poll_duration_seconds', 'Response time of the CCU for a poll of the states, drives the poll interval',
+    ['ccu'], buckets=FETCH_BUCKETS)
+hm2prom_poll_interval = Gauge('hm2prom_poll_interval_seconds', 'Current interval between polls of the CCU states', ['ccu'])
+hm2prom_last_successful_poll = Gauge('hm2prom_last_successful_poll_timestamp', 'Unix time of the last successful poll of the CCU states', ['ccu'])
 
 # Homematic CCU URL paths as described in https://www.homematic-inside.de/software/addons/item/xmlapi
 CCU_roomlist_URL="/config/xmlapi/roomlist.cgi"
@@ -105,371 +207,1548 @@ CCU_rssilist_URL="/config/xmlapi/rssilist.cgi"
 # 6. System Variable: Variables which could be used in homematic web-ui programms and in homeamtic scripts
 # 7. RSSI: Information about the signal strength of homematic wireless devices RX (receiving) TX (sending) direction
 
-# fetch and cache devices and rommslists from the CCU for later processing and performace optimization,
-#  querys can take some time due to limited CCU ressource,
-devlist = ET.fromstring(urllib.request.urlopen(Homematic_CCU_URL+CCU_devicelist_URL).read())
-roomlist = ET.fromstring(urllib.request.urlopen(Homematic_CCU_URL+CCU_roomlist_URL).read())
-statelist = ET.fromstring(urllib.request.urlopen(Homematic_CCU_URL+CCU_statelist_URL).read())
-functionlist = ET.fromstring(urllib.request.urlopen(Homematic_CCU_URL+CCU_functionlist_URL).read())
-sysvarlist = ET.fromstring(urllib.request.urlopen(Homematic_CCU_URL+CCU_sysvarlist_URL).read())
-rssilist = ET.fromstring(urllib.request.urlopen(Homematic_CCU_URL+CCU_rssilist_URL).read())
+# Valuetypes of datapoints and types of sysvars as used by the CCU, they select the value converter
+VALUETYPE_BOOL='2'
+VALUETYPE_ENUM='16'     # Integer datapoints and sysvars, sysvars with a valueList are enums whose value is an index into it
+VALUETYPE_STRING='20'
+
+# RSSI value of the rssilist if the radio strength of a direction is unknown
+RSSI_UNKNOWN=65536
+
+# Homematic booleans are "true" or "false" which is 1 and 0 by convention in prometheus
+BOOL_VALUES={'true': 1.0, 'false': 0.0, '1': 1.0, '0': 0.0}
+
+# Attributes which are needed from the lists that get refetched every loop, everything else is dropped while parsing
+STATELIST_ATTRIBUTES=('ise_id', 'value', 'valuetype', 'timestamp')
+SYSVARLIST_ATTRIBUTES=('ise_id', 'name', 'type', 'value', 'valueList', 'unit', 'timestamp')
+RSSILIST_ATTRIBUTES=('device', 'rx', 'tx')
+
+# Attributes of a HomematicCCU which are written to the snapshot file, the labels and samples are rebuilt out of them on restore.
+#  SNAPSHOT_VERSION has to be increased whenever the content of these attributes changes, older snapshots are ignored then.
+SNAPSHOT_ATTRIBUTES=('topology_hashes', 'channel_list', 'sysvar_list', 'rssi_list', 'channel_rooms_index', 'channel_functions_index',
+    'channel_information_index', 'device_information_index', 'device_address_index', 'device_rooms_index', 'channel_datapoints_index',
+    'datapoint_information_index',
+    'datapoint_state_index', 'sysvar_state_index', 'rssi_state_index', 'snapshot_timestamp')
+SNAPSHOT_VERSION=3
+
+# Worker threads which fetch the lists in parallel, they are shared by all CCUs. The requests are queued per CCU and at most
+#  CCU_Max_Connections of a single CCU are handed to the workers at a time, see HomematicCCU.submit_request.
+ccu_fetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=Worker_Threads)
+
+# All CCUs which are exported by this process, normalized CCU URL -> HomematicCCU
+ccu_targets = {}
+
+# Interface ids which were registered for events at the CCUs, interface id -> HomematicCCU
+event_interfaces = {}
 
 
 #############FUNCTIONS#################################
 
 
+def normalize_ccu_url(ccu_url):  # Normalize a CCU URL or a plain host name, used as key for the probe targets
+    ccu_url = ccu_url.strip().rstrip('/')
+    if '://' not in ccu_url:
+        ccu_url = 'http://' + ccu_url
+    return (ccu_url)
 
-def get_rooms_for_channel(channel_iseid):        # Get room for channel out of roomlist
-    global channel_rooms
-    channel_rooms=[]
-    if channel_iseid is not None:
-        try:
-            for room in roomlist.iter('room'):
-                    for channel in room.iter('channel'):
-                        if channel.attrib.get('ise_id') == channel_iseid:  # Extract all rooms for the channel write it in a list.
-                            channel_rooms.append(room.attrib.get('name'))
-        except:
-            print("Failed to find room for this channel")
-    return (channel_rooms)
 
+def states_label_names():   # Label names of hm2prom_states depending on Compact_Labels
+    return (HM2PROM_STATES_COMPACT_LABELS if Compact_Labels else HM2PROM_STATES_LABELS)
 
-def get_functions_for_channel(channel_iseid):        # Get room for channel out of roomlist
-    global channel_functions
-    channel_functions=[]
-    if channel_iseid is not None:
-        try:
-            for functions in functionlist.iter('function'):
-                    for channel in functions.iter('channel'):
-                        if channel.attrib.get('ise_id') == channel_iseid:  # Extract all rooms for the channel write it in a list.
-                            channel_functions.append(functions.attrib.get('name'))
-        except:
-            print("Failed to get functions for this channel")
-    return (channel_functions)
 
+def ccu_host_name(ccu_url):    # Host and port of a CCU URL with every character that is not allowed in a file name replaced
+    return (''.join(character if character.isalnum() or character in '.-' else '_' for character in urllib.parse.urlsplit(ccu_url).netloc))
 
-def get_channel_information(channel_iseid):  # Get relevant information for the channel and write it to dictonary "channel_information"
-    global channel_information
-    if channel_iseid is not None:
-        try:
-            for channel in devlist.iter('channel'):
-                if channel.attrib.get('ise_id') == channel_iseid:
-
-                    channel_information = {
-                        'channel_ise_ids': channel.attrib.get('ise_id'),
-                        'channel_address' : channel.attrib.get('address'),
-                        'channel_name': channel.attrib.get('name'),
-                        'channel_type': channel.attrib.get('type'),
-                        'channel_parent_device': channel.attrib.get('parent_device'),
-                        'channel_direction': channel.attrib.get('direction')
-                    }
-        except:
-                print("Failed to get channel iformation for this device")
-    return (channel_information)
 
+def snapshot_path(ccu_url):     # Path of the snapshot file of a CCU in Snapshot_Directory
+    return (os.path.join(Snapshot_Directory, 'hm2prom_%s.pickle' % ccu_host_name(ccu_url)))
 
-def get_channels_ise_ids(device_ise_id):
-    global channel_ise_ids
-    channel_ise_ids =[]  # empty list for appending
-    if device_ise_id is not None:
-        try:
-            for channel in devlist.iter('channel'):
-                if channel.attrib.get('parent_device') == device_ise_id:  # Extract all channels which belong to the given parent device ise_id and write it in a list.
-                    channel_ise_ids.append(channel.attrib.get('ise_id'))
-        except:
-            print("Failed to get channels for this device")
-    return (channel_ise_ids)
 
+def recording_path(directory, ccu_url, path, sequence):    # Path of a recorded xmlapi response, the query of a path is
+    # represented by a hash to keep the file names short
+    endpoint, _, query = path.partition('?')
+    name = ccu_endpoint(endpoint) + ('_' + hashlib.sha1(query.encode()).hexdigest()[:12] if query else '')
+    return (os.path.join(directory, ccu_host_name(ccu_url), '%s.%s.xml' % (name, sequence)))
 
-def get_device_by_address(device_address):      # Resolve device ise_id by there hardware address, needed for mapping of RSSI strength
-    global device_by_address
-    device_by_address = []
-    if device_address is not None:
-        try:
-            for address in devlist.iter('device'):
-                if channel.attrib.get('address') == device_address:  # Extract matching channel from devlist
-                            device_information = {
-                                'device_name': device.attrib.get("name"),
-                                'device_address': device.attrib.get("address"),
-                                'device_ise_id': device.attrib.get("ise_id"),
-                                'device_type': device.attrib.get("device_type")
-                            }
-        except:
-            print("Failed to get device by address")
-    return (device_information)
 
+def callback_address(ccu_host, port):   # Host of the XML-RPC callback URL, Event_Callback_Host or the local IP of the route to the CCU
+    if Event_Callback_Host:
+        return (Event_Callback_Host)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        probe.connect((ccu_host, port))     # No packet is sent, only the route is resolved
+        return (probe.getsockname()[0])
 
-def get_channel_parent_deviceinfo(channel_iseid):        # Get parent for channel
-    global channel_parent_deviceinfo
-    channel_parent_deviceinfo=[]
-    if channel_iseid is not None:
-        try:
-            for channel in devlist.iter('channel'):
-                if channel.attrib.get('ise_id') == channel_iseid:  # Extract matching channel from devlist
-                        channel_parent_device = channel.attrib.get('parent_device')
-                        for device in devlist.iter('device'):
-                            if device.attrib.get('ise_id') == channel_parent_device:
-                                parent_device_information = {
-                                    'parent_device_name': device.attrib.get("name"),
-                                    'parent_device_address': device.attrib.get("address"),
-                                    'parent_device_ise_id': device.attrib.get("ise_id"),
-                                    'parent_device_type': device.attrib.get("device_type")
-                                }
-        except:
-            print("Failed to get parent device for this channel")
-    return (parent_device_information)
 
+def event_value(value):     # Convert a XML-RPC event value to the string representation of the statelist
+    if isinstance(value, bool):
+        return ('true' if value else 'false')
+    return (str(value))
 
-def get_datapoints_by_channel(channel_iseid):  # Get all the datapoints for the channel there are sensors with mutlitple values on one channel
-    global datapoints_by_channel
-    datapoints_by_channel=[]
-    if channel_iseid is not None:
-        try:
-            for channel in statelist.iter('channel'):
-                if channel.attrib.get('ise_id') == channel_iseid:
-                    #print("channel possiton id:", channel)  # dbg
-                    for datapoint in channel.iter('datapoint'):
-                        #print ("datapoit possiton id:", datapoint) #dbg
-                        datapoints_by_channel.append(datapoint.attrib.get('ise_id'))
-        except:
-                print("Failed to get channel for datapoint")
-    return (datapoints_by_channel)
 
+def ccu_endpoint(path):   # Name of the xmlapi endpoint of a path e.g. statelist, used as label for the self instrumentation
+    return (path.split('?')[0].rsplit('/', 1)[-1].split('.')[0])
 
-def get_states_by_datapoint(datapoint_iseid):  # Get state and value information (payload) for datapoints
-    global states_by_datapoint
-    state_by_datapoint={}
-    if datapoint_iseid is not None:
-        try:
-            for datapoint in statelist.iter('datapoint'):
-                if datapoint.attrib.get('ise_id') == datapoint_iseid:
-                    #print("datapoint possiton id:", datapoint)  # dbg
-                    state_by_datapoint.update({
-                            'datapoint_ise_id': datapoint.attrib.get('ise_id'),
-                            'datapoint_name': datapoint.attrib.get('name'),
-                            'datapoint_type': datapoint.attrib.get('type'),
-                            'datapoint_value': datapoint.attrib.get('value'),
-                            'datapoint_value_type': datapoint.attrib.get('valuetype'),
-                            'datapoint_value_unit': datapoint.attrib.get('valueunit'),
-                            'datapoint_timestamp_epoch': datapoint.attrib.get('timestamp'), # Timestamp is in unix epoch and UTC
-                             })
-                    if state_by_datapoint.get('datapoint_value')=='false':      # Check if homeatic value is boolean
-                        # "true" or "false" which is "1" and "0" by convention in prometheus
-                        #print("False State") #dbg
-                        state_by_datapoint["datapoint_value"] = 0
-                    if state_by_datapoint.get('datapoint_value') == 'true':
-                        #print("True State")  # dbg
-                        state_by_datapoint["datapoint_value"] = 1
-                        #print ("Matching Datapoint ISE_ID:", datapoint.attrib.get('ise_id')) #dbg
 
-        except:
-                print("Failed to get state for datapoint")
-    return (state_by_datapoint)
+class CountingReader(object):   # File like wrapper around a CCU response which counts the received bytes and the time spent
+    # waiting for them, so the parse time can be separated from the transfer time
+
+    def __init__(self, response, record_file=None):
+        self.response = response
+        self.record_file = record_file  # Gets a copy of the raw response if it is recorded
+        self.bytes = 0
+        self.read_seconds = 0
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self.response.read(size if size is not None and size >= 0 else None)
+        self.read_seconds = self.read_seconds + time.perf_counter() - start
+        self.bytes = self.bytes + len(data)
+        if self.record_file is not None:
+            self.record_file.write(data)
+        return (data)
+
 
+def parse_topology_list(response):   # Parse a complete xmlapi list into an ElementTree, only used for the topology lists.
+    # Returns (content hash, tree), the hash is used to detect changes of the topology.
+    data = response.read()
+    return ((hashlib.sha1(data).hexdigest(), ET.fromstring(data)))
 
-def get_state_by_sysvar(sysvar_ise_id):  #Get state and value information (payload) for sysvars
-    global state_by_sysvar
-    state_by_sysvar={}
-    if sysvar_ise_id is not None:
+
+def parse_statelist_topology(response):  # Parse a complete statelist into an ElementTree. Returns (structure hash, tree), the
+    # hash only covers channels and the static datapoint attributes because values and timestamps change every time.
+    statelist = ET.parse(response).getroot()
+    structure_hash = hashlib.sha1()
+    for channel in statelist.iter('channel'):
+        structure_hash.update(('c%s\0' % channel.attrib.get('ise_id')).encode())
+        for datapoint in channel.iter('datapoint'):
+            structure_hash.update(('\0'.join(str(datapoint.attrib.get(attribute)) for attribute in
+                ('ise_id', 'name', 'type', 'valuetype', 'valueunit')) + '\0').encode())
+    return ((structure_hash.hexdigest(), statelist))
+
+
+def index_statelist_tree(statelist):    # Index the datapoint values of a complete statelist tree by ise_id
+    return ({datapoint.attrib.get('ise_id'): {attribute: datapoint.attrib.get(attribute) for attribute in STATELIST_ATTRIBUTES}
+        for datapoint in statelist.iter('datapoint')})
+
+
+def topology_content_hashes(ccu_lists):     # Extract the content hashes of the topology lists out of a fetch_topology result
+    return ({name: ccu_lists[name][0] for name in ('devicelist', 'roomlist', 'functionlist', 'statelist')})
+
+
+def iterparse_ccu_list(response, tag, attributes):    # Stream a xmlapi list from a CCU response and yield the requested attributes
+    # of every element with the given tag. The response is fed in chunks to the parser and every element is cleared after it
+    # was processed, so neither the raw response nor the complete tree is kept in memory.
+    parser = ET.XMLPullParser(events=('end',))
+    while True:
+        chunk = response.read(Stream_Chunk_Size)
+        if not chunk:
+            break
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            if element.tag == tag:
+                yield {attribute: element.attrib.get(attribute) for attribute in attributes}
+            element.clear()
+    parser.close()
+    for event, element in parser.read_events():
+        if element.tag == tag:
+            yield {attribute: element.attrib.get(attribute) for attribute in attributes}
+
+
+def parse_statelist(response):     # Index the datapoint values of a statelist response by ise_id
+    return ({datapoint['ise_id']: datapoint for datapoint in iterparse_ccu_list(response, 'datapoint', STATELIST_ATTRIBUTES)})
+
+
+def parse_state(response):     # Index the datapoint values of a state.cgi response by ise_id. Depending on the xmlapi version
+    # state.cgi only returns ise_id and value, the missing attributes are None.
+    return (parse_statelist(response))
+
+
+def parse_sysvarlist(response):     # Index the sysvar values of a sysvarlist response by ise_id
+    return ({sysvar['ise_id']: sysvar for sysvar in iterparse_ccu_list(response, 'systemVariable', SYSVARLIST_ATTRIBUTES)})
+
+
+def parse_rssilist(response):     # Index the radio strength values of a rssilist response by device address
+    return ({rssi['device']: rssi for rssi in iterparse_ccu_list(response, 'rssi', RSSILIST_ATTRIBUTES)})
+
+
+def convert_float(value):   # Convert a numeric value to a float, returns None if there is no value. Raises ValueError if the
+    # value can not be converted.
+    if value:
+        return (float(value))
+    return (None)
+
+
+def convert_none(value):    # Values without a numeric representation, e.g. strings
+    return (None)
+
+
+def build_value_converter(valuetype, value_list=None):  # Build the converter of a datapoint or sysvar out of its valuetype once,
+    # the converter is a single call value -> float or None. Enums map the names of the valueList and their indexes to the index.
+    if valuetype == VALUETYPE_BOOL:
+        return (BOOL_VALUES.get)
+    if valuetype == VALUETYPE_ENUM and value_list:
+        enum_values = {}
+        for index, name in enumerate(value_list.split(';')):
+            enum_values[name] = float(index)
+            enum_values[str(index)] = float(index)
+        return (enum_values.get)
+    if valuetype == VALUETYPE_STRING:
+        return (convert_none)
+    return (convert_float)
+
+
+def convert_timestamp(timestamp):    # Convert a CCU timestamp (unix epoch, UTC) to a float, returns None if the CCU provides none
+    try:
+        return (float(timestamp))
+    except (TypeError, ValueError):
+        return (None)
+
+
+def build_samples(name, labels, value, timestamp):   # Build the value sample and the companion last change sample, the last
+    # change is also exported for values without a numeric representation
+    value_sample = None
+    last_change_sample = None
+    if value is not None:
+        value_sample = Sample(name, labels, value)
+    if timestamp is not None:
+        last_change_sample = Sample(name + '_last_change_seconds', labels, timestamp)
+    return (value_sample, last_change_sample)
+
+
+class CycleProfiler(object):    # Profiles the next poll cycles of all CCUs with cProfile and tracemalloc and writes a report to
+    # Profile_Directory. A poll cycle covers fetching and parsing the lists and rebuilding the changed samples.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.remaining = 0      # Poll cycles which still have to be profiled
+        self.cycles = 0
+        self.profile = None
+        self.started = 0
+
+    def start(self, cycles=None):     # Returns False if a profiling run is already in progress
+        cycles = cycles or Profile_Cycles
+        with self.lock:
+            if self.remaining:
+                return (False)
+            self.profile = cProfile.Profile()
+            self.cycles = cycles
+            self.started = time.time()
+            tracemalloc.start()
+            self.remaining = cycles
+        print("Profiling the next %s poll cycles" % cycles)
+        return (True)
+
+    def run(self, function):    # Run a poll cycle, profiled if a profiling run is in progress. Profiled cycles are serialized
+        # over all CCUs.
+        if not self.remaining:
+            return (function())
+        with self.lock:
+            if not self.remaining:
+                return (function())
+            try:
+                return (self.profile.runcall(function))
+            finally:
+                self.remaining = self.remaining - 1
+                if not self.remaining:
+                    self.write_report()
+
+    def write_report(self):     # Write the cProfile statistics and the top allocations, has to be called with lock held
+        memory_snapshot = tracemalloc.take_snapshot()
+        memory_current, memory_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        report = io.StringIO()
+        report.write("hm2prom profile of %s poll cycles started %s\n\n" % (self.cycles, time.ctime(self.started)))
+        stats = pstats.Stats(self.profile, stream=report)
+        stats.sort_stats('cumulative').print_stats(40)
+        stats.sort_stats('tottime').print_stats(25)
+        report.write("Traced memory: %.1f MB current, %.1f MB peak\n\nTop allocations:\n" % (memory_current / 1048576, memory_peak / 1048576))
+        for statistic in memory_snapshot.statistics('lineno')[:25]:
+            report.write("%s\n" % statistic)
+        path = os.path.join(Profile_Directory, 'hm2prom_profile_%s' % time.strftime('%Y%m%d_%H%M%S', time.localtime(self.started)))
+        try:
+            with open(path + '.txt', 'w') as report_file:
+                report_file.write(report.getvalue())
+            stats.dump_stats(path + '.pstats')
+            print("Profile written to %s.txt" % path)
+        except OSError as error:
+            print("Failed to write the profile to %s: %s" % (path, error))
+            print(report.getvalue())
+        self.profile = None
+
+
+# Profiler for the poll cycles, started by SIGUSR1 or /debug/profile
+cycle_profiler = CycleProfiler()
+
+
+class RingBufferStore(object):  # Value changes of the datapoints in array backed ring buffers of Aggregation_Ring_Size entries per
+    # datapoint. Every datapoint gets a dense slot, the ring of a slot starts at slot * Aggregation_Ring_Size in the times and
+    # values arrays. The rings of datapoints which also exist in the previous store are taken over.
+
+    def __init__(self, datapoints, previous=None):
+        self.slots = {datapoint: slot for slot, datapoint in enumerate(datapoints)}   # datapoint ise_id -> slot
+        self.times = array.array('d', [0.0]) * (len(self.slots) * Aggregation_Ring_Size)
+        self.values = array.array('d', [0.0]) * (len(self.slots) * Aggregation_Ring_Size)
+        self.heads = array.array('l', [0]) * len(self.slots)       # Position of the newest entry in the ring
+        self.counts = array.array('l', [0]) * len(self.slots)      # Number of used entries
+        self.changes = array.array('d', [0.0]) * len(self.slots)   # Value changes since the start, exported as counter
+        if previous is not None:
+            for datapoint, slot in self.slots.items():
+                previous_slot = previous.slots.get(datapoint)
+                if previous_slot is None:
+                    continue
+                start, previous_start = slot * Aggregation_Ring_Size, previous_slot * Aggregation_Ring_Size
+                self.times[start:start + Aggregation_Ring_Size] = previous.times[previous_start:previous_start + Aggregation_Ring_Size]
+                self.values[start:start + Aggregation_Ring_Size] = previous.values[previous_start:previous_start + Aggregation_Ring_Size]
+                self.heads[slot] = previous.heads[previous_slot]
+                self.counts[slot] = previous.counts[previous_slot]
+                self.changes[slot] = previous.changes[previous_slot]
+
+    def record(self, datapoint, timestamp, value):  # Append a value to the ring of a datapoint if it differs from the newest entry,
+        # the first value of a datapoint is not counted as change
+        slot = self.slots.get(datapoint)
+        if slot is None:
+            return
+        start = slot * Aggregation_Ring_Size
+        if self.counts[slot]:
+            if self.values[start + self.heads[slot]] == value:
+                return
+            self.changes[slot] = self.changes[slot] + 1
+            self.heads[slot] = (self.heads[slot] + 1) % Aggregation_Ring_Size
+        self.times[start + self.heads[slot]] = timestamp
+        self.values[start + self.heads[slot]] = value
+        self.counts[slot] = min(self.counts[slot] + 1, Aggregation_Ring_Size)
+
+    def aggregate(self, datapoint, now, window):    # Min, max and time weighted average of a datapoint over the window, plus the
+        # total number of changes and the time of the newest change. The value which was valid at the start of the window is
+        # included. Returns None if nothing was recorded.
+        slot = self.slots.get(datapoint)
+        if slot is None or not self.counts[slot]:
+            return (None)
+        start = slot * Aggregation_Ring_Size
+        window_start = now - window
+        segment_end = now
+        weighted_sum = 0.0
+        covered = 0.0
+        value_min = value_max = None
+        for age in range(self.counts[slot]):    # Newest to oldest entry, every entry is valid until the next newer one
+            position = start + (self.heads[slot] - age) % Aggregation_Ring_Size
+            timestamp, value = self.times[position], self.values[position]
+            segment_start = max(timestamp, window_start)
+            if segment_end > segment_start:
+                weighted_sum = weighted_sum + value * (segment_end - segment_start)
+                covered = covered + segment_end - segment_start
+            value_min = value if value_min is None else min(value_min, value)
+            value_max = value if value_max is None else max(value_max, value)
+            if timestamp <= window_start:
+                break
+            segment_end = timestamp
+        newest = start + self.heads[slot]
+        value_avg = weighted_sum / covered if covered else self.values[newest]
+        return ((value_min, value_max, value_avg, self.changes[slot], self.times[newest]))
+
+
+class HomematicCCU(object):    # Connection pool, topology index and cached states of a single CCU
+
+    def __init__(self, ccu_url):
+        self.ccu_url = normalize_ccu_url(ccu_url)
+        self.connection_pool = queue.LifoQueue()     # Idle keep-alive connections to the CCU
+        self.request_lock = threading.Lock()
+        self.queued_requests = collections.deque()    # (future, path, parse) of requests which wait for a free connection slot
+        self.running_requests = 0       # Requests of this CCU which were handed to ccu_fetch_executor, at most CCU_Max_Connections
+        self.record_lock = threading.Lock()
+        self.record_sequences = {}      # xmlapi path -> number of recorded or replayed responses
+        self.replay_files = {}          # xmlapi path -> recorded responses in Replay_Directory
+        self.snapshot_lock = threading.Lock()     # Held while the cached states and samples are updated or collected, never during a fetch
+        self.poll_lock = threading.Lock()     # Held during a poll of the states, concurrent polls are coalesced into a single CCU fetch
+        self.snapshot_timestamp = 0
+        self.saved_snapshot_timestamp = 0     # snapshot_timestamp of the last snapshot which was written to Snapshot_Directory
+        self.poll_interval = Interval     # Current poll interval, lengthened by schedule_next_poll while the CCU is slow or failing
+        self.next_poll = 0
+        self.generation = 0     # Incremented whenever the cached samples were updated, invalidates the exposition cache
+        self.loaded = False
+        self.topology_hashes = {}
+        self.channel_list = []
+        self.sysvar_list = []
+        self.rssi_list = []
+        self.datapoint_labels_index = {}
+        self.channel_info_samples = []
+        self.device_info_samples = []
+        self.datapoint_state_index = {}
+        self.merged_states = {}     # datapoint ise_id -> (fetch timestamp, state) merged since the start of the last full sweep
+        self.datapoint_event_index = {}
+        self.datapoint_converters = {}      # datapoint ise_id -> value converter, built out of the valuetype of the topology
+        self.sysvar_converters = {}         # sysvar ise_id -> ((type, valueList), value converter)
+        self.aggregation_store = RingBufferStore({})
+        self.aggregation_samples = {}       # datapoint ise_id -> (min sample, max sample, avg sample, changes sample)
+        self.aggregation_active = set()     # datapoint ise_ids whose aggregation samples have to be recomputed on the next collect
+        self.sysvar_state_index = {}
+        self.rssi_state_index = {}
+        self.device_address_index = {}
+        self.device_rooms_index = {}
+        self.device_versions = {}       # device or channel address -> VERSION of its description, announced by newDevices
+        self.event_registrations = {}   # XML-RPC port of an interface process -> callback URL registered there
+        self.datapoint_samples = {}      # datapoint ise_id -> (last seen timestamp, last seen value, value sample, last change sample)
+        self.sysvar_samples = {}         # sysvar ise_id -> (last seen timestamp, last seen value, value sample, last change sample, labels)
+        self.rssi_samples = {}           # device address -> (last seen rx, last seen tx, rx sample, tx sample)
+        self.series_changed = False      # Set when a datapoint sample appeared or disappeared, hm2prom_series has to be recounted
+        self.registry = CollectorRegistry()     # Registry which only contains this CCU, exported on /probe
+        self.registry.register(HomematicCollector(self))
+        self.exposition = ExpositionCache(self.registry, [self])
+        self.expositions = []       # Expositions with a renderer thread which contain this CCU, rendered after its samples changed
+
+
+    def new_connection(self):   # Open a new HTTP connection to the CCU, the timeout is enforced for connect and every read
+        ccu_url = urllib.parse.urlsplit(self.ccu_url)
+        if ccu_url.scheme == 'https':
+            return (http.client.HTTPSConnection(ccu_url.hostname, ccu_url.port, timeout=CCU_Timeout))
+        return (http.client.HTTPConnection(ccu_url.hostname, ccu_url.port, timeout=CCU_Timeout))
+
+
+    def request(self, path, parse):    # GET a xmlapi path over a pooled keep-alive connection and return parse(response).
+        # A pooled connection might have been closed by the CCU in the meantime, in this case the request is repeated once
+        # on a new connection. With Replay_Directory the response is read from the recorded responses instead.
+        endpoint = ccu_endpoint(path)
+        start = time.perf_counter()
+        if Replay_Directory:
+            with open(self.next_replay_path(path), 'rb') as recorded_response:
+                result = self.parse_response(path, recorded_response, parse)
+            hm2prom_fetch_duration.labels(self.ccu_url, endpoint).observe(time.perf_counter() - start)
+            return (result)
+        try:
+            connection = self.connection_pool.get_nowait()
+            reused = True
+        except queue.Empty:
+            connection = self.new_connection()
+            reused = False
         try:
-            for sysvar in sysvarlist.iter('systemVariable'):
-                if sysvar.attrib.get('ise_id') == sysvar_ise_id:
-                    #print("sysvar possiton id:", sysvar)  # dbg
-                    state_by_sysvar.update({
-                            'sysvar_ise_id': sysvar.attrib.get('ise_id'),
-                            'sysvar_name': sysvar.attrib.get('name'),
-                            'sysvar_type': sysvar.attrib.get('type'),
-                            'sysvar_value': sysvar.attrib.get('value'),
-                            'sysvar_value_type': sysvar.attrib.get('valuelist'),
-                            'sysvar_value_unit': sysvar.attrib.get('unit'),
-                            'sysvar_timestamp_epoch': sysvar.attrib.get('timestamp'), # Timestamp is in unix epoch and UTC
-                             })
-                    if state_by_sysvar.get('sysvar_value')=='false':      # Check if homeatic value is boolean "true" or "false" which is "1" and "0" by convention in prometheus
-                        #print("False State") #dbg
-                        state_by_sysvar["sysvar_value"] = 0
-                    if state_by_sysvar.get('sysvar_value') == 'true':
-                        #print("True State")  # dbg
-                        state_by_sysvar["sysvar_value"] = 1
-                        #print ("Matching sysvar ISE_ID:", sysvar.attrib.get('ise_id')) #dbg
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+            except (http.client.HTTPException, ConnectionError):
+                if not reused:
+                    raise
+                connection.close()
+                connection = self.new_connection()
+                connection.request('GET', path)
+                response = connection.getresponse()
+            if response.status != 200:
+                raise http.client.HTTPException("CCU returned HTTP status %s for %s" % (response.status, path))
+            result = self.parse_response(path, response, parse)
         except:
-                print("Failed to get state for sysvar")
-    return (state_by_sysvar)
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self.connection_pool.put(connection)
+        hm2prom_fetch_duration.labels(self.ccu_url, endpoint).observe(time.perf_counter() - start)
+        return (result)
 
 
-def get_rssi_by_address(device_address):  #Get state and value information (payload) for sysvars
-    global rssi_by_address
-    state_by_sysvar={}
-    if device_address is not None:
+    def submit_request(self, path, parse):  # Queue a request for the shared ccu_fetch_executor and return its future. The
+        # requests of this CCU are only handed to the executor while less than CCU_Max_Connections of them are running, so a
+        # slow CCU never occupies more workers than that and can not starve the other CCUs.
+        future = concurrent.futures.Future()
+        with self.request_lock:
+            self.queued_requests.append((future, path, parse))
+            self.dispatch_requests()
+        return (future)
+
+
+    def dispatch_requests(self):    # Hand queued requests to the executor up to CCU_Max_Connections, has to be called with request_lock held
+        while self.queued_requests and self.running_requests < CCU_Max_Connections:
+            self.running_requests = self.running_requests + 1
+            ccu_fetch_executor.submit(self.run_request, *self.queued_requests.popleft())
+
+
+    def run_request(self, future, path, parse):     # Run a queued request in an executor worker and dispatch the next one
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self.request(path, parse))
+                except BaseException as error:
+                    future.set_exception(error)
+        finally:
+            with self.request_lock:
+                self.running_requests = self.running_requests - 1
+                self.dispatch_requests()
+
+
+    def parse_response(self, path, response, parse):   # Parse a xmlapi response and drain the rest of it, the response is copied to
+        # Record_Directory while it is read if recording is enabled
+        endpoint = ccu_endpoint(path)
+        record_path = None
+        record_file = None
+        if Record_Directory and not Replay_Directory:
+            with self.record_lock:
+                sequence = self.record_sequences.get(path, 0)
+                if sequence < Record_Limit:
+                    self.record_sequences[path] = sequence + 1
+                    record_path = recording_path(Record_Directory, self.ccu_url, path, sequence)
+        try:
+            if record_path is not None:
+                os.makedirs(os.path.dirname(record_path), exist_ok=True)
+                record_file = open(record_path + '.tmp', 'wb')
+            reader = CountingReader(response, record_file)
+            parse_start = time.perf_counter()
+            result = parse(reader)
+            hm2prom_parse_duration.labels(self.ccu_url, endpoint).observe(time.perf_counter() - parse_start - reader.read_seconds)
+            reader.read()     # Drain the rest of the body, otherwise the connection can not be reused
+            hm2prom_fetch_bytes.labels(self.ccu_url, endpoint).inc(reader.bytes)
+        except:
+            if record_file is not None:     # A partial response is useless for a replay
+                record_file.close()
+                os.unlink(record_path + '.tmp')
+            raise
+        if record_file is not None:
+            record_file.close()
+            os.replace(record_path + '.tmp', record_path)
+        return (result)
+
+
+    def next_replay_path(self, path):   # Path of the next recorded response of a xmlapi path in Replay_Directory, the recorded
+        # responses are returned in the order of their sequence and start over after the last one
+        with self.record_lock:
+            recorded_responses = self.replay_files.get(path)
+            if recorded_responses is None:
+                pattern = recording_path(Replay_Directory, self.ccu_url, path, '*')
+                recorded_responses = sorted(glob.glob(pattern), key=lambda name: int(name.rsplit('.', 2)[1]))
+                self.replay_files[path] = recorded_responses
+            if not recorded_responses:
+                raise FileNotFoundError("No recorded response for %s in %s" % (path, Replay_Directory))
+            sequence = self.record_sequences.get(path, 0)
+            self.record_sequences[path] = sequence + 1
+            return (recorded_responses[sequence % len(recorded_responses)])
+
+
+    def fetch_lists(self, requests):  # Fetch several xmlapi lists in parallel. requests is a dictionary name -> (path, parse),
+        # the result is a dictionary name -> parsed list. The first failed request raises its exception. While the cycle profiler
+        # is running the lists are fetched one after another in the calling thread, cProfile only sees the profiled thread.
+        if cycle_profiler.remaining:
+            return ({name: self.request(path, parse) for name, (path, parse) in requests.items()})
+        futures = {name: self.submit_request(path, parse) for name, (path, parse) in requests.items()}
+        return ({name: future.result() for name, future in futures.items()})
+
+
+    def fetch_topology(self, additional_requests={}):    # Fetch devicelist, roomlist, functionlist and statelist for the topology
+        # index in parallel, additional requests are fetched within the same batch
+        requests = {
+            'devicelist': (CCU_devicelist_URL, parse_topology_list),
+            'roomlist': (CCU_roomlist_URL, parse_topology_list),
+            'functionlist': (CCU_functionlist_URL, parse_topology_list),
+            'statelist': (CCU_statelist_URL, parse_statelist_topology)}
+        requests.update(additional_requests)
+        return (self.fetch_lists(requests))
+
+
+    def load(self):     # fetch and cache all lists from the CCU in parallel for later processing and performace optimization,
+        # querys can take some time due to limited CCU ressource. The statelist tree is only needed once to build the topology index.
+        load_timestamp = time.time()
+        ccu_lists = self.fetch_topology({
+            'sysvarlist': (CCU_sysvarlist_URL, parse_sysvarlist),
+            'rssilist': (CCU_rssilist_URL, parse_rssilist)})
+        with self.snapshot_lock:
+            self.topology_hashes = topology_content_hashes(ccu_lists)
+            self.sysvar_state_index = ccu_lists['sysvarlist']
+            self.rssi_state_index = ccu_lists['rssilist']
+
+            # Build the topology index. It contains the list with all channels of all devices registered in the CCU, which is the
+            #  base information for the upcoming querries, and dictionaries for rooms, functions, parent devices and datapoints
+            #  per channel. It gets refreshed by the topology_refresher thread. The xml trees are not kept, only the index.
+            self.build_topology_index(ccu_lists['devicelist'][1], ccu_lists['roomlist'][1], ccu_lists['functionlist'][1], ccu_lists['statelist'][1])
+            self.build_datapoint_indexes()
+            self.datapoint_state_index = index_statelist_tree(ccu_lists['statelist'][1])
+            self.sysvar_list = list(self.sysvar_state_index)     # list with all system variables registered in the CCU
+            self.rssi_list = list(self.rssi_state_index)     # list with addresses for devices with RSSI radio strenght parameters
+            self.snapshot_timestamp = load_timestamp
+            self.next_poll = time.time() + self.poll_interval
+            self.update_state_samples()
+            self.generation = self.generation + 1
+            self.loaded = True
+        hm2prom_last_successful_poll.labels(self.ccu_url).set(self.snapshot_timestamp)
+        print("CCU:", self.ccu_url)
+        print ("channel_list:", self.channel_list) #dbg might be helfull to identify consistence issues between ccu and script
+        print("Number of registered channels: %s" % len(self.channel_list)) #dbg
+        print("Number of registered datapoints: %s" % len(self.datapoint_labels_index)) #dbg
+        print ("sysvar_list:", self.sysvar_list) # dbg might be helfull to identify consistence issues between ccu and script
+        print("Number of registered system variables: %s" % len(self.sysvar_list)) #dbg
+        print ("rssi_list:", self.rssi_list) # dbg might be helfull to identify consistence issues between ccu and script
+        print("Number of wireless devices: %s" % len(self.rssi_list)) #dbg
+        print("\n")
+
+
+    def restore_snapshot(self):     # Load topology and states from the snapshot file written by save_snapshot, so the CCU can be
+        # exported before it was loaded. The states are polled right away and the topology is revalidated by the topology_refresher.
+        if not Snapshot_Directory:
+            return
         try:
-            for rssi in rssilist.iter('rssi'):
-                if rssi.attrib.get('device') == device_address:
-                    rssi_by_address.update({
-                            'rssi_address': rssi.attrib.get('device'),
-                            'rssi_rx_value': rssi.attrib.get('rx'),
-                            'rssi_tx_value': rssi.attrib.get('tx'),
-                            'rssi_ise_id': get_device_by_address(rssi),
-                             })
+            with open(snapshot_path(self.ccu_url), 'rb') as snapshot_file:
+                snapshot = pickle.load(snapshot_file)
+        except FileNotFoundError:
+            return
         except:
-                print("Failed to get rssi information for address")
-    return (rssi_by_address)
+            print("Failed to read the snapshot of CCU %s" % self.ccu_url)
+            traceback.print_exc()
+            return
+        if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('ccu_url') != self.ccu_url:
+            print("Ignoring outdated snapshot of CCU %s" % self.ccu_url)
+            return
+        with self.snapshot_lock:
+            for name in SNAPSHOT_ATTRIBUTES:
+                setattr(self, name, snapshot[name])
+            self.build_datapoint_indexes()
+            self.update_state_samples()
+            self.saved_snapshot_timestamp = self.snapshot_timestamp
+            self.next_poll = time.time()
+            self.generation = self.generation + 1
+            self.loaded = True
+        hm2prom_last_successful_poll.labels(self.ccu_url).set(self.snapshot_timestamp)
+        print("Restored CCU %s from the snapshot of %s with %s datapoints" % (self.ccu_url, time.ctime(self.snapshot_timestamp), len(self.datapoint_labels_index)))
+
+
+    def save_snapshot(self):    # Write topology and states to the snapshot file. The file is replaced atomically, a crash while
+        # writing leaves the previous snapshot intact.
+        with self.snapshot_lock:
+            snapshot_timestamp = self.snapshot_timestamp
+            snapshot = pickle.dumps(dict({name: getattr(self, name) for name in SNAPSHOT_ATTRIBUTES},
+                version=SNAPSHOT_VERSION, ccu_url=self.ccu_url), protocol=pickle.HIGHEST_PROTOCOL)
+        path = snapshot_path(self.ccu_url)
+        try:
+            # The snapshot is loaded with pickle, so only the user of hm2prom may write the directory and the file
+            os.makedirs(Snapshot_Directory, mode=0o700, exist_ok=True)
+            with open(os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as snapshot_file:
+                snapshot_file.write(snapshot)
+            os.replace(path + '.tmp', path)
+        except OSError as error:
+            print("Failed to write the snapshot of CCU %s: %s" % (self.ccu_url, error))
+        self.saved_snapshot_timestamp = snapshot_timestamp
+
+
+    def build_topology_index(self, devlist, roomlist, functionlist, statelist):     # Walk the topology lists exactly once and build
+        # dictionaries for all lookups needed in the main loop. Before this every lookup scanned the whole xml tree per channel and datapoint.
+        self.channel_rooms_index={}           # channel ise_id -> [room names]
+        self.channel_functions_index={}       # channel ise_id -> [function names]
+        self.channel_information_index={}     # channel ise_id -> channel information dict
+        self.device_information_index={}      # device ise_id -> device information dict
+        self.device_address_index={}          # device address -> device ise_id, maps the rssilist to the devices
+        self.device_rooms_index={}            # device ise_id -> [room names of all its channels]
+        self.channel_datapoints_index={}      # channel ise_id -> [datapoint ise_ids]
+        self.datapoint_information_index={}   # datapoint ise_id -> static datapoint attributes (name, type, valuetype, unit)
+        self.channel_list=[]
+        for room in roomlist.iter('room'):
+            for channel in room.iter('channel'):
+                self.channel_rooms_index.setdefault(channel.attrib.get('ise_id'), []).append(room.attrib.get('name'))
+        for function in functionlist.iter('function'):
+            for channel in function.iter('channel'):
+                self.channel_functions_index.setdefault(channel.attrib.get('ise_id'), []).append(function.attrib.get('name'))
+        for device in devlist.iter('device'):
+            self.device_information_index[device.attrib.get('ise_id')] = {
+                'parent_device_name': device.attrib.get("name"),
+                'parent_device_address': device.attrib.get("address"),
+                'parent_device_ise_id': device.attrib.get("ise_id"),
+                'parent_device_type': device.attrib.get("device_type")
+            }
+            self.device_address_index[device.attrib.get('address')] = device.attrib.get('ise_id')
+            device_rooms = set()
+            for channel in device.iter('channel'):
+                device_rooms.update(self.channel_rooms_index.get(channel.attrib.get('ise_id'), []))
+                self.channel_list.append(channel.attrib.get('ise_id'))
+                self.channel_information_index[channel.attrib.get('ise_id')] = {
+                    'channel_ise_ids': channel.attrib.get('ise_id'),
+                    'channel_address' : channel.attrib.get('address'),
+                    'channel_name': channel.attrib.get('name'),
+                    'channel_type': channel.attrib.get('type'),
+                    'channel_parent_device': channel.attrib.get('parent_device'),
+                    'channel_direction': channel.attrib.get('direction')
+                }
+            self.device_rooms_index[device.attrib.get('ise_id')] = sorted(device_rooms)
+        for channel in statelist.iter('channel'):
+            datapoints=self.channel_datapoints_index.setdefault(channel.attrib.get('ise_id'), [])
+            for datapoint in channel.iter('datapoint'):
+                datapoints.append(datapoint.attrib.get('ise_id'))
+                self.datapoint_information_index[datapoint.attrib.get('ise_id')] = {
+                    'datapoint_ise_id': datapoint.attrib.get('ise_id'),
+                    'datapoint_name': datapoint.attrib.get('name'),
+                    'datapoint_type': datapoint.attrib.get('type'),
+                    'datapoint_value_type': datapoint.attrib.get('valuetype'),
+                    'datapoint_value_unit': datapoint.attrib.get('valueunit'),
+                }
+
+
+    def build_datapoint_labels(self):   # Precompute the complete label tuple of hm2prom_states for every datapoint of every channel.
+        # The order has to match the label declaration of hm2prom_states. With Compact_Labels the info samples per channel and device
+        # are built instead of repeating their labels on every datapoint.
+        self.datapoint_labels_index={}
+        self.channel_info_samples=[]
+        self.device_info_samples=[]
+        if Compact_Labels:
+            for device_information in self.device_information_index.values():
+                self.device_info_samples.append(Sample('hm2prom_device_info', dict(zip(HM2PROM_DEVICE_INFO_LABELS, (str(label) for label in (
+                    device_information.get('parent_device_ise_id'),
+                    device_information.get('parent_device_address'),
+                    device_information.get('parent_device_name'),
+                    device_information.get('parent_device_type'))))), 1))
+        for channel in self.channel_list:
+            channel_roomname = self.get_rooms_for_channel(channel)
+            channel_functions = self.get_functions_for_channel(channel)
+            channel_parent = self.get_channel_parent_deviceinfo(channel)
+            channel_information = self.get_channel_information(channel)
+            if Compact_Labels:
+                self.channel_info_samples.append(Sample('hm2prom_channel_info', dict(zip(HM2PROM_CHANNEL_INFO_LABELS, (str(label) for label in (
+                    channel,
+                    channel_information.get('channel_address'),
+                    channel_information.get('channel_name'),
+                    channel_information.get('channel_type'),
+                    channel_information.get('channel_direction'),
+                    channel_roomname,
+                    channel_functions,
+                    channel_information.get('channel_parent_device'))))), 1))
+                for datapoint in self.get_datapoints_by_channel(channel):
+                    datapoint_information = self.datapoint_information_index.get(datapoint, {})
+                    self.datapoint_labels_index[datapoint] = tuple(str(label) for label in (
+                        datapoint,
+                        channel,
+                        datapoint_information.get('datapoint_name'),
+                        datapoint_information.get('datapoint_type'),
+                        datapoint_information.get('datapoint_value_type'),
+                        datapoint_information.get('datapoint_value_unit')))
+                continue
+            for datapoint in self.get_datapoints_by_channel(channel):
+                datapoint_information = self.datapoint_information_index.get(datapoint, {})
+                self.datapoint_labels_index[datapoint] = tuple(str(label) for label in (
+                    datapoint_information.get('datapoint_ise_id'),
+                    datapoint_information.get('datapoint_name'),
+                    datapoint_information.get('datapoint_type'),
+                    datapoint_information.get('datapoint_value_type'),
+                    datapoint_information.get('datapoint_value_unit'),
+                    channel,
+                    channel_information.get('channel_address'),
+                    channel_information.get('channel_name'),
+                    channel_information.get('channel_type'),
+                    channel_information.get('channel_parent_device'),
+                    channel_information.get('channel_direction'),
+                    channel_roomname,
+                    channel_functions,
+                    channel_parent.get('parent_device_ise_id'),
+                    channel_parent.get('parent_device_address'),
+                    channel_parent.get('parent_device_name'),
+                    channel_parent.get('parent_device_type')))
+
+
+    def build_datapoint_indexes(self):  # Rebuild everything which is derived from the topology index per datapoint, has to be called
+        # with snapshot_lock held whenever the topology index was built or restored
+        self.build_datapoint_labels()
+        self.build_event_index()
+        self.build_datapoint_converters()
+        # The rings are only allocated if the aggregation is enabled
+        self.aggregation_store = RingBufferStore(self.datapoint_labels_index if Aggregation_Window else {}, self.aggregation_store)
+        self.aggregation_samples = {}
+        self.aggregation_active = set(self.aggregation_store.slots)     # Recompute the aggregation samples with the new labels
+
+
+    def build_datapoint_converters(self):   # Build the value converter of every datapoint out of its valuetype
+        self.datapoint_converters={datapoint: build_value_converter(datapoint_information.get('datapoint_value_type'))
+            for datapoint, datapoint_information in self.datapoint_information_index.items()}
+
+
+    def build_event_index(self):    # Index the datapoint ise_ids by <channel address>.<value key> for the XML-RPC events. The
+        # datapoint names of the statelist are <interface>.<channel address>.<value key>, the addresses are unique over all interfaces.
+        self.datapoint_event_index={}
+        for datapoint, datapoint_information in self.datapoint_information_index.items():
+            datapoint_name = str(datapoint_information.get('datapoint_name'))
+            if datapoint_name.count('.') >= 2:
+                self.datapoint_event_index[datapoint_name.split('.', 1)[1]] = datapoint
+
+
+    def build_state_index(self):    # Fetch the current statelist, sysvarlist and rssilist in parallel and index the values by
+        # ise_id and device address, has to be called every loop. Returns (datapoint, sysvar, rssi) state index, they are
+        # swapped in by poll_states.
+        ccu_lists = self.fetch_lists({
+            'statelist': (CCU_statelist_URL, parse_statelist),
+            'sysvarlist': (CCU_sysvarlist_URL, parse_sysvarlist),
+            'rssilist': (CCU_rssilist_URL, parse_rssilist)})
+        return ((ccu_lists['statelist'], ccu_lists['sysvarlist'], ccu_lists['rssilist']))
+
+
+    def get_rooms_for_channel(self, channel_iseid):        # Get room for channel out of the room index
+        return (self.channel_rooms_index.get(channel_iseid, []))
+
+
+    def get_functions_for_channel(self, channel_iseid):        # Get functions for channel out of the function index
+        return (self.channel_functions_index.get(channel_iseid, []))
+
+
+    def get_channel_information(self, channel_iseid):  # Get relevant information for the channel out of the channel index
+        return (self.channel_information_index.get(channel_iseid, {}))
+
+
+    def get_device_by_address(self, device_address):      # Resolve the device information by there hardware address out of the
+        # address index, needed for mapping of RSSI strength
+        return (self.device_information_index.get(self.device_address_index.get(device_address), {}))
+
+
+    def get_rooms_for_device(self, device_ise_id):     # Get the rooms of all channels of a device out of the device room index
+        return (self.device_rooms_index.get(device_ise_id, []))
+
+
+    def get_channel_parent_deviceinfo(self, channel_iseid):        # Get parent for channel
+        channel_parent_device = self.get_channel_information(channel_iseid).get('channel_parent_device')
+        return (self.device_information_index.get(channel_parent_device, {}))
+
+
+    def get_datapoints_by_channel(self, channel_iseid):  # Get all the datapoints for the channel there are sensors with mutlitple values on one channel
+        return (self.channel_datapoints_index.get(channel_iseid, []))
+
+
+    def get_states_by_datapoint(self, datapoint_iseid):  # Get state and value information (payload) for datapoints
+        state_by_datapoint={}
+        datapoint = self.datapoint_state_index.get(datapoint_iseid)
+        if datapoint is not None:
+            state_by_datapoint.update(self.datapoint_information_index.get(datapoint_iseid, {}))  # name, type and unit are static
+            state_by_datapoint.update({
+                    'datapoint_ise_id': datapoint.get('ise_id'),
+                    'datapoint_value': datapoint.get('value'),
+                    'datapoint_value_type': datapoint.get('valuetype'),
+                    'datapoint_timestamp_epoch': datapoint.get('timestamp'), # Timestamp is in unix epoch and UTC
+                     })
+        return (state_by_datapoint)
+
+
+    def get_state_by_sysvar(self, sysvar_ise_id):  #Get state and value information (payload) for sysvars
+        state_by_sysvar={}
+        sysvar = self.sysvar_state_index.get(sysvar_ise_id)
+        if sysvar is not None:
+            state_by_sysvar.update({
+                    'sysvar_ise_id': sysvar.get('ise_id'),
+                    'sysvar_name': sysvar.get('name'),
+                    'sysvar_type': sysvar.get('type'),
+                    'sysvar_value': sysvar.get('value'),
+                    'sysvar_value_list': sysvar.get('valueList'),
+                    'sysvar_value_unit': sysvar.get('unit'),
+                    'sysvar_timestamp_epoch': sysvar.get('timestamp'), # Timestamp is in unix epoch and UTC
+                     })
+        return (state_by_sysvar)
+
+
+    def get_rssi_by_address(self, device_address):  #Get radio strength information (payload) and the device it belongs to
+        rssi_by_address={}
+        rssi = self.rssi_state_index.get(device_address)
+        if rssi is not None:
+            device_information = self.get_device_by_address(device_address)
+            rssi_by_address.update({
+                    'rssi_address': rssi.get('device'),
+                    'rssi_rx_value': rssi.get('rx'),
+                    'rssi_tx_value': rssi.get('tx'),
+                    'rssi_devicename': device_information.get('parent_device_name', ''),
+                    'rssi_room': self.get_rooms_for_device(device_information.get('parent_device_ise_id')),
+                     })
+        return (rssi_by_address)
+
+
+    def refresh_topology(self):     # Refetch the topology lists from the CCU. If their content hashes did not change nothing is done,
+        # otherwise the index is rebuilt and the cached samples of datapoints which disappeared or whose labels changed are evicted.
+        topology_timestamp = time.time()
+        ccu_lists = self.fetch_topology()
+        hashes = topology_content_hashes(ccu_lists)
+        with self.snapshot_lock:
+            if hashes == self.topology_hashes:
+                return
+            update_start = time.perf_counter()
+            previous_labels_index = self.datapoint_labels_index
+            self.build_topology_index(ccu_lists['devicelist'][1], ccu_lists['roomlist'][1], ccu_lists['functionlist'][1], ccu_lists['statelist'][1])
+            self.build_datapoint_indexes()
+            datapoint_state_index = index_statelist_tree(ccu_lists['statelist'][1])
+            self.apply_merged_states(datapoint_state_index, topology_timestamp)
+            self.datapoint_state_index = datapoint_state_index
+            self.topology_hashes = hashes
+            evicted = 0
+            for datapoint, datapoint_labels in previous_labels_index.items():
+                if self.datapoint_labels_index.get(datapoint) != datapoint_labels:
+                    self.datapoint_samples.pop(datapoint, None)     # Stale label set, gets rebuilt with the new labels if it still exists
+                    evicted = evicted + 1
+            self.rssi_samples = {}      # Device names and rooms might have changed, the radio strength samples are cheap to rebuild
+            self.update_state_samples()
+            self.generation = self.generation + 1
+            self.saved_snapshot_timestamp = 0    # The changed topology is written with the next poll
+            hm2prom_update_duration.labels(self.ccu_url).observe(time.perf_counter() - update_start)
+        print("Topology of %s changed, %s datapoints registered, %s label sets evicted" % (self.ccu_url, len(self.datapoint_labels_index), evicted))
+
+
+    def apply_merged_states(self, datapoint_state_index, fetch_timestamp):  # Apply the states of hot datapoints and events which were
+        # merged after a full statelist was fetched to its index, so swapping it in does not roll them back. Has to be called with
+        # snapshot_lock held.
+        for datapoint, (merge_timestamp, state) in self.merged_states.items():
+            if merge_timestamp > fetch_timestamp and datapoint in datapoint_state_index:
+                datapoint_state_index[datapoint] = state
+
+
+    def topology_refresher(self):   # Background thread which loads the CCU if this was not done yet and refreshes the topology
+        # every Topology_Interval seconds. A failed load is retried with the backoff of schedule_next_poll. A topology restored
+        # from the snapshot is revalidated right away, until this succeeds it is retried with the current poll interval.
+        revalidated = not self.loaded
+        refresh_delay = Topology_Interval if revalidated else 0
+        while not self.loaded:
+            try:
+                self.load()
+                self.render_expositions()
+            except:
+                print("Failed to load the lists from CCU %s" % self.ccu_url)
+                traceback.print_exc()
+                hm2prom_errors.labels(self.ccu_url, 'topology').inc()
+                self.schedule_next_poll(time.time(), 0, True)    # A CCU which is down is retried with the same backoff as the polls
+                time.sleep(max(0, self.next_poll - time.time()))
+        while True:
+            time.sleep(refresh_delay)
+            try:
+                self.refresh_topology()
+                self.render_expositions()
+                revalidated = True
+                refresh_delay = Topology_Interval
+            except:
+                print("Failed to refresh the topology of CCU %s" % self.ccu_url)
+                traceback.print_exc()
+                hm2prom_errors.labels(self.ccu_url, 'topology').inc()
+                refresh_delay = Topology_Interval if revalidated else self.poll_interval
+
+
+    def update_datapoint_samples(self, datapoints):     # Rebuild the samples of the given datapoint ise_ids whose (timestamp, value)
+        # changed since the last fetch, has to be called with snapshot_lock held. Returns the number of rebuilt samples.
+        changed = 0
+        for datapoint in datapoints:
+            datapoint_labels = self.datapoint_labels_index.get(datapoint)
+            if datapoint_labels is None:
+                continue
+            state = self.datapoint_state_index.get(datapoint)
+            if state is None:
+                if self.datapoint_samples.pop(datapoint, None) is not None:
+                    self.series_changed = True
+                continue
+            last_seen = self.datapoint_samples.get(datapoint)
+            if last_seen is not None and last_seen[0] == state['timestamp'] and last_seen[1] == state['value']:
+                continue
+            try:
+                datapoint_value = self.datapoint_converters.get(datapoint, convert_float)(state['value'])
+            except ValueError:
+                print ("datapoint_value could not be converted to a float")
+                print(self.get_states_by_datapoint(datapoint))
+                hm2prom_errors.labels(self.ccu_url, 'value_conversion').inc()
+                datapoint_value = None
+            self.datapoint_samples[datapoint] = (state['timestamp'], state['value']) + build_samples(
+                'hm2prom_states',
+                dict(zip(states_label_names(), datapoint_labels)),
+                datapoint_value,
+                convert_timestamp(state['timestamp']))
+            if last_seen is None or (last_seen[2] is None) != (datapoint_value is None) or (last_seen[3] is None) != (self.datapoint_samples[datapoint][3] is None):
+                self.series_changed = True
+            if Aggregation_Window and datapoint_value is not None:
+                self.aggregation_store.record(datapoint, time.time(), datapoint_value)
+                self.aggregation_active.add(datapoint)
+            changed = changed + 1
+        return (changed)
+
+
+    def update_state_samples(self):     # Compare the fetched states with the last seen (timestamp, value) per ise_id, the conversion
+        # and the samples are only rebuilt for datapoints and sysvars which changed since the last fetch, the same applies to the
+        # radio strength per device address. Has to be called with snapshot_lock held after new state indexes were swapped in.
+        self.update_datapoint_samples(self.datapoint_labels_index)
+
+        # The sysvarlist is fetched every loop, so deleted sysvars are evicted and new ones are exported right away
+        for sysvar in set(self.sysvar_list) - set(self.sysvar_state_index):
+            self.sysvar_samples.pop(sysvar, None)
+            self.sysvar_converters.pop(sysvar, None)
+        self.sysvar_list = list(self.sysvar_state_index)
+        for sysvar, state in self.sysvar_state_index.items():
+            # The labels come from the same sysvarlist row as the value, a renamed sysvar is rebuilt even if its value is unchanged
+            sysvar_labels = tuple(str(state[attribute]) for attribute in ('ise_id', 'name', 'type', 'valueList', 'unit'))
+            last_seen = self.sysvar_samples.get(sysvar)
+            if last_seen is not None and last_seen[0] == state['timestamp'] and last_seen[1] == state['value'] and last_seen[4] == sysvar_labels:
+                continue
+            sysvar_converter = self.sysvar_converters.get(sysvar)
+            if sysvar_converter is None or sysvar_converter[0] != (state['type'], state['valueList']):     # New sysvar or changed type
+                sysvar_converter = ((state['type'], state['valueList']), build_value_converter(state['type'], state['valueList']))
+                self.sysvar_converters[sysvar] = sysvar_converter
+            try:
+                sysvar_value = sysvar_converter[1](state['value'])
+            except ValueError:
+                print ("sysvar_value could not be converted to a float")
+                print(self.get_state_by_sysvar(sysvar))
+                hm2prom_errors.labels(self.ccu_url, 'value_conversion').inc()
+                sysvar_value = None
+            self.sysvar_samples[sysvar] = (state['timestamp'], state['value']) + build_samples(
+                'hm2prom_sysvar',
+                dict(zip(HM2PROM_SYSVAR_LABELS, sysvar_labels)),
+                sysvar_value,
+                convert_timestamp(state['timestamp'])) + (sysvar_labels,)
+
+        for device_address in set(self.rssi_samples) - set(self.rssi_state_index):
+            self.rssi_samples.pop(device_address)
+        for device_address, rssi in self.rssi_state_index.items():
+            last_seen = self.rssi_samples.get(device_address)
+            if last_seen is not None and last_seen[0] == rssi['rx'] and last_seen[1] == rssi['tx']:
+                continue
+            current_rssi = self.get_rssi_by_address(device_address)
+            rssi_samples = []
+            for name, direction, value in (('hm2prom_rssi_rx', 'rx', rssi['rx']), ('hm2prom_rssi_tx', 'tx', rssi['tx'])):
+                try:
+                    rssi_value = convert_float(value)
+                except ValueError:
+                    print ("rssi_value could not be converted to a float")
+                    print(current_rssi)
+                    hm2prom_errors.labels(self.ccu_url, 'value_conversion').inc()
+                    rssi_value = None
+                if rssi_value is None or rssi_value == RSSI_UNKNOWN:
+                    rssi_samples.append(None)
+                    continue
+                rssi_samples.append(Sample(name, dict(zip(HM2PROM_RSSI_LABELS, [str(label) for label in (
+                    current_rssi.get('rssi_address'),
+                    current_rssi.get('rssi_devicename'),
+                    current_rssi.get('rssi_room'),
+                    direction)])), rssi_value))
+            self.rssi_samples[device_address] = (rssi['rx'], rssi['tx']) + tuple(rssi_samples)
+        self.update_series_counts()
+
+
+    def update_series_counts(self):     # Count the cached samples per metric family into hm2prom_series, has to be called with
+        # snapshot_lock held whenever samples appeared or disappeared. The counts are set before the exposition is rendered, on
+        # /metrics the gauge is collected before the CCU.
+        series = {}
+        for samples, value_family, last_change_family in (
+                (self.datapoint_samples, 'hm2prom_states', 'hm2prom_states_last_change_seconds'),
+                (self.sysvar_samples, 'hm2prom_sysvar', 'hm2prom_sysvar_last_change_seconds'),
+                (self.rssi_samples, 'hm2prom_rssi_rx', 'hm2prom_rssi_tx')):
+            series[value_family] = sum(1 for last_seen in samples.values() if last_seen[2] is not None)
+            series[last_change_family] = sum(1 for last_seen in samples.values() if last_seen[3] is not None)
+        if Compact_Labels:
+            series['hm2prom_channel_info'] = len(self.channel_info_samples)
+            series['hm2prom_device_info'] = len(self.device_info_samples)
+        if Aggregation_Window:
+            self.update_aggregation_samples()
+            for family in ('hm2prom_states_min', 'hm2prom_states_max', 'hm2prom_states_avg', 'hm2prom_states_changes'):
+                series[family] = len(self.aggregation_samples)
+        for family, count in series.items():
+            hm2prom_series.labels(self.ccu_url, family).set(count)
+        self.series_changed = False
+
+
+    def update_aggregation_samples(self):   # Recompute the min, max, avg and changes samples of the datapoints which changed within
+        # the last Aggregation_Window. Datapoints without a change in the window are computed one last time, their samples then stay
+        # constant and are reused. Has to be called with snapshot_lock held.
+        now = time.time()
+        for datapoint in list(self.aggregation_active):
+            last_seen = self.datapoint_samples.get(datapoint)
+            if last_seen is None or last_seen[2] is None or datapoint not in self.aggregation_store.slots:
+                self.aggregation_samples.pop(datapoint, None)
+                self.aggregation_active.discard(datapoint)
+                continue
+            aggregation = self.aggregation_store.aggregate(datapoint, now, Aggregation_Window)
+            if aggregation is None:
+                continue
+            value_min, value_max, value_avg, changes, last_change = aggregation
+            labels = last_seen[2].labels
+            self.aggregation_samples[datapoint] = (
+                Sample('hm2prom_states_min', labels, value_min),
+                Sample('hm2prom_states_max', labels, value_max),
+                Sample('hm2prom_states_avg', labels, value_avg),
+                Sample('hm2prom_states_changes_total', labels, changes))
+            if last_change <= now - Aggregation_Window:
+                self.aggregation_active.discard(datapoint)
+
+
+    def schedule_next_poll(self, scheduled, latency, failed):   # Adapt the poll interval to the measured response time of the CCU.
+        # A failed or slow poll multiplies the interval by Poll_Backoff_Factor up to Interval_Max, every healthy poll divides it
+        # again until Interval is reached. While the CCU is healthy the polls keep a fixed rate relative to the scheduled time, so
+        # the cadence does not drift by the poll duration. A lengthened interval is randomized by Poll_Jitter.
+        if failed or latency > Poll_Latency_Threshold:
+            self.poll_interval = min(Interval_Max, self.poll_interval * Poll_Backoff_Factor)
+        else:
+            self.poll_interval = max(Interval, self.poll_interval / Poll_Backoff_Factor)
+        hm2prom_poll_interval.labels(self.ccu_url).set(self.poll_interval)
+        now = time.time()
+        if failed:
+            self.next_poll = now + self.poll_interval * random.uniform(1 - Poll_Jitter, 1 + Poll_Jitter)
+        elif self.poll_interval > Interval:
+            self.next_poll = scheduled + self.poll_interval * random.uniform(1 - Poll_Jitter, 1 + Poll_Jitter)
+        else:
+            self.next_poll = scheduled + self.poll_interval
+        if self.next_poll <= now:   # Polls which were missed while the CCU was busy are skipped, not made up
+            self.next_poll = self.next_poll + (int((now - self.next_poll) // self.poll_interval) + 1) * self.poll_interval
+
+
+    def poll_states(self):  # Fetch the states and rebuild the samples of the changed values, a single poll cycle. The lists are
+        # fetched without snapshot_lock, it is only held to swap them in, so scrapes, hot datapoints and events do not wait for
+        # the CCU. Returns the duration of the fetch.
+        poll_timestamp = time.time()
+        poll_start = time.perf_counter()
+        datapoint_state_index, sysvar_state_index, rssi_state_index = self.build_state_index()
+        fetch_duration = time.perf_counter() - poll_start
+        hm2prom_poll_duration.labels(self.ccu_url).observe(fetch_duration)
+        with self.snapshot_lock:
+            update_start = time.perf_counter()
+            self.apply_merged_states(datapoint_state_index, poll_timestamp)
+            self.merged_states = {}
+            self.datapoint_state_index = datapoint_state_index
+            self.sysvar_state_index = sysvar_state_index
+            self.rssi_state_index = rssi_state_index
+            self.rssi_list = list(self.rssi_state_index)
+            self.update_state_samples()
+            self.snapshot_timestamp = poll_timestamp    # Time the states were fetched, merges of older fetches are skipped
+            self.generation = self.generation + 1
+            hm2prom_update_duration.labels(self.ccu_url).observe(time.perf_counter() - update_start)
+        hm2prom_last_successful_poll.labels(self.ccu_url).set(self.snapshot_timestamp)
+        return (fetch_duration)
+
+
+    def refresh_snapshot(self):     # Refetch the states from the CCU if the next poll is due. Concurrent callers wait for
+        # poll_lock and reuse the snapshot that was fetched meanwhile, so they result in a single CCU fetch.
+        with self.poll_lock:
+            if not self.loaded or time.time() < self.next_poll:
+                return
+            scheduled = self.next_poll
+            profiled = cycle_profiler.remaining > 0     # Profiled cycles are slowed down by cProfile and fetch serially
+            fetch_duration = 0
+            failed = True
+            try:
+                fetch_duration = cycle_profiler.run(self.poll_states)
+                failed = False
+            except ET.ParseError:
+                print("XML parsing error or invalid XML received from CCU %s" % self.ccu_url)  # Under some circumstances load? the CCU produces invalid XML output
+                traceback.print_exc()
+                hm2prom_errors.labels(self.ccu_url, 'xml_parsing').inc()
+            except:
+                print("Failed to fetch the states from CCU %s" % self.ccu_url)
+                traceback.print_exc()
+                hm2prom_errors.labels(self.ccu_url, 'fetch').inc()
+            # Set before the lock is released, waiting callers must not retry a failing CCU immediately. Only the fetch counts
+            #  as response time of the CCU, not rebuilding the samples.
+            self.schedule_next_poll(scheduled, 0 if profiled else fetch_duration, failed)
+
+
+    def render_expositions(self):   # Wake the renderer threads of the expositions which contain this CCU after its samples
+        # changed, so scrapes only serve the pre rendered bodies
+        for exposition in self.expositions:
+            exposition.refresh()
+
+
+    def state_poller(self):     # Background thread which polls the states whenever schedule_next_poll says the next poll is due,
+        # renders the expositions and writes the snapshot every Snapshot_Save_Interval
+        while True:
+            delay = self.next_poll - time.time() if self.loaded else Interval
+            if delay > 0:
+                time.sleep(delay)
+            self.refresh_snapshot()
+            self.render_expositions()
+            if Snapshot_Directory and self.snapshot_timestamp - self.saved_snapshot_timestamp >= Snapshot_Save_Interval:
+                self.save_snapshot()
+
+
+    def get_hot_datapoints(self):   # Sorted ise_ids of all known datapoints of Hot_Datapoints and Hot_Channels
+        hot_datapoints = set(str(datapoint) for datapoint in Hot_Datapoints)
+        for channel in Hot_Channels:
+            hot_datapoints.update(self.get_datapoints_by_channel(str(channel)))
+        return (sorted(datapoint for datapoint in hot_datapoints if datapoint in self.datapoint_labels_index))
+
+
+    def refresh_hot_states(self):   # Fetch the values of the hot datapoints via state.cgi in batches of Hot_Batch_Size and merge
+        # them into the datapoint state index. The batches are queued by submit_request, at most CCU_Max_Connections of them are
+        # fetched at a time.
+        hot_datapoints = self.get_hot_datapoints()
+        if not hot_datapoints:
+            return
+        fetch_timestamp = time.time()
+        ccu_lists = self.fetch_lists({batch: ('%s?datapoint_id=%s' % (CCU_state_URL, ','.join(hot_datapoints[batch:batch + Hot_Batch_Size])), parse_state)
+            for batch in range(0, len(hot_datapoints), Hot_Batch_Size)})
+        hot_states = {}
+        for batch_states in ccu_lists.values():
+            hot_states.update(batch_states)
+        self.merge_datapoint_states(hot_states, fetch_timestamp)
+
+
+    def merge_datapoint_states(self, states, fetch_timestamp):   # Merge single datapoint states of state.cgi or the XML-RPC events
+        # into the datapoint state index and rebuild their samples. Attributes which are None are kept from the last full sweep, a
+        # changed value without a timestamp gets the fetch time as timestamp of the last change. States which were fetched before
+        # the last full sweep are outdated and skipped, states merged while a sweep is fetched are applied to it as well.
+        with self.snapshot_lock:
+            if fetch_timestamp < self.snapshot_timestamp:
+                return
+            for datapoint, state in states.items():
+                previous_state = self.datapoint_state_index.get(datapoint)
+                if previous_state is None or state['value'] is None:
+                    continue
+                if state['timestamp'] is None:
+                    state['timestamp'] = previous_state['timestamp'] if state['value'] == previous_state['value'] else str(int(fetch_timestamp))
+                if state['valuetype'] is None:
+                    state['valuetype'] = previous_state['valuetype']
+                self.datapoint_state_index[datapoint] = state
+                self.merged_states[datapoint] = (fetch_timestamp, state)
+            if self.update_datapoint_samples(states):
+                self.generation = self.generation + 1
+                if self.series_changed or Aggregation_Window:
+                    self.update_series_counts()
+        self.render_expositions()
+
+
+    def hot_poller(self):   # Background thread which polls the hot datapoints at a fixed rate of Hot_Interval. While the full
+        # sweep backs off, the hot interval is lengthened in the same ratio.
+        next_poll = time.time()
+        while True:
+            hot_interval = Hot_Interval * self.poll_interval / Interval
+            next_poll = max(next_poll + hot_interval, time.time())
+            if self.loaded:
+                try:
+                    self.refresh_hot_states()
+                except:
+                    print("Failed to fetch the hot datapoints from CCU %s" % self.ccu_url)
+                    traceback.print_exc()
+                    hm2prom_errors.labels(self.ccu_url, 'fetch').inc()
+            time.sleep(max(0, next_poll - time.time()))
+
+
+    def apply_event(self, address, value_key, value):  # Apply a datapoint event pushed by an interface process of the CCU, events
+        # of datapoints which are not in the topology index (e.g. CENTRAL.PONG) are ignored
+        datapoint = self.datapoint_event_index.get('%s.%s' % (address, value_key))
+        if datapoint is None:
+            return
+        hm2prom_events.labels(self.ccu_url).inc()
+        self.merge_datapoint_states({datapoint: {'ise_id': datapoint, 'value': event_value(value), 'valuetype': None, 'timestamp': None}}, time.time())
+
+
+    def list_devices(self):     # Descriptions of all devices and channels of the topology index for listDevices, the interface
+        # processes only announce addresses with newDevices which are not contained. A VERSION is only known from newDevices.
+        with self.snapshot_lock:
+            addresses = list(self.device_address_index)
+            addresses.extend(channel_information.get('channel_address') for channel_information in self.channel_information_index.values())
+            device_versions = dict(self.device_versions)
+        device_descriptions = []
+        for address in addresses:
+            if address is None:
+                continue
+            device_description = {'ADDRESS': address}
+            if address in device_versions:
+                device_description['VERSION'] = device_versions[address]
+            device_descriptions.append(device_description)
+        return (device_descriptions)
+
+
+    def event_registrar(self, callback_port):     # Background thread which registers the callback server at every interface
+        # process in Event_Interfaces and renews the registration every Event_Reinit_Interval. A failed registration is retried
+        # with the current poll interval.
+        ccu_host = urllib.parse.urlsplit(self.ccu_url).hostname
+        while True:
+            registered = True
+            for port in Event_Interfaces:
+                interface_id = 'hm2prom-%s-%d' % (ccu_host_name(self.ccu_url), port)
+                event_interfaces[interface_id] = self
+                try:
+                    callback_url = 'http://%s:%d' % (callback_address(ccu_host, port), callback_port)
+                    xmlrpc.client.ServerProxy('http://%s:%d' % (ccu_host, port)).init(callback_url, interface_id)
+                    self.event_registrations[port] = callback_url
+                except:
+                    print("Failed to register %s for events at port %s of CCU %s" % (interface_id, port, self.ccu_url))
+                    traceback.print_exc()
+                    hm2prom_errors.labels(self.ccu_url, 'event_registration').inc()
+                    registered = False
+            time.sleep(Event_Reinit_Interval if registered else self.poll_interval)
+
+
+    def unregister_events(self):    # Remove the registrations of the callback server with init(url) without interface id, called on shutdown
+        ccu_host = urllib.parse.urlsplit(self.ccu_url).hostname
+        for port, callback_url in list(self.event_registrations.items()):
+            try:
+                xmlrpc.client.ServerProxy('http://%s:%d' % (ccu_host, port)).init(callback_url)
+                self.event_registrations.pop(port, None)
+            except:
+                print("Failed to unregister from events at port %s of CCU %s" % (port, self.ccu_url))
+                traceback.print_exc()
+
+
+class HomematicCollector(object):   # Custom collector which builds the metrics of a CCU out of the cached snapshot on every scrape
+
+    def __init__(self, ccu):
+        self.ccu = ccu
+
+    def describe(self):     # Avoid a CCU fetch when the collector gets registered
+        return (self.build_metric_families())
+
+    def build_metric_families(self):
+        metric_families = (
+            GaugeMetricFamily('hm2prom_states', 'Homematic export metrics', labels=states_label_names()),
+            GaugeMetricFamily('hm2prom_states_last_change_seconds', 'Homematic datapoint timestamp of the last change', labels=states_label_names()),
+            GaugeMetricFamily('hm2prom_sysvar', 'Homematic export sysvar', labels=HM2PROM_SYSVAR_LABELS),
+            GaugeMetricFamily('hm2prom_sysvar_last_change_seconds', 'Homematic sysvar timestamp of the last change', labels=HM2PROM_SYSVAR_LABELS),
+            GaugeMetricFamily('hm2prom_rssi_rx', 'Homematic export rssi (receive) radio strength', labels=HM2PROM_RSSI_LABELS),
+            GaugeMetricFamily('hm2prom_rssi_tx', 'Homematic export rssi (transmit) radio strength', labels=HM2PROM_RSSI_LABELS))
+        if Compact_Labels:
+            metric_families = metric_families + (
+                GaugeMetricFamily('hm2prom_channel_info', 'Homematic channel metadata', labels=HM2PROM_CHANNEL_INFO_LABELS),
+                GaugeMetricFamily('hm2prom_device_info', 'Homematic device metadata', labels=HM2PROM_DEVICE_INFO_LABELS))
+        if Aggregation_Window:
+            metric_families = metric_families + (
+                GaugeMetricFamily('hm2prom_states_min', 'Homematic datapoint minimum over the aggregation window', labels=states_label_names()),
+                GaugeMetricFamily('hm2prom_states_max', 'Homematic datapoint maximum over the aggregation window', labels=states_label_names()),
+                GaugeMetricFamily('hm2prom_states_avg', 'Homematic datapoint time weighted average over the aggregation window', labels=states_label_names()),
+                CounterMetricFamily('hm2prom_states_changes', 'Homematic datapoint value changes seen by hm2prom', labels=states_label_names()))
+        return (metric_families)
+
+    def collect(self):
+        metric_families = self.build_metric_families()
+        hm2prom_states, hm2prom_states_last_change, hm2prom_sysvar, hm2prom_sysvar_last_change, hm2prom_rssi_rx, hm2prom_rssi_tx = metric_families[:6]
+        with self.ccu.snapshot_lock:     # Only the cached samples are collected, they are rebuilt for changed values by update_state_samples
+            for samples, value_family, last_change_family in (
+                    (self.ccu.datapoint_samples, hm2prom_states, hm2prom_states_last_change),
+                    (self.ccu.sysvar_samples, hm2prom_sysvar, hm2prom_sysvar_last_change),
+                    (self.ccu.rssi_samples, hm2prom_rssi_rx, hm2prom_rssi_tx)):     # (last seen rx, last seen tx, rx sample, tx sample)
+                for last_seen in samples.values():
+                    if last_seen[2] is not None:
+                        value_family.samples.append(last_seen[2])
+                    if last_seen[3] is not None:
+                        last_change_family.samples.append(last_seen[3])
+            if Compact_Labels:
+                metric_families[6].samples.extend(self.ccu.channel_info_samples)
+                metric_families[7].samples.extend(self.ccu.device_info_samples)
+            if Aggregation_Window:
+                self.ccu.update_aggregation_samples()
+                aggregation_families = metric_families[-4:]
+                for aggregation_samples in self.ccu.aggregation_samples.values():
+                    for aggregation_family, sample in zip(aggregation_families, aggregation_samples):
+                        aggregation_family.samples.append(sample)
+        for metric_family in metric_families:     # hm2prom_series is counted by update_series_counts before the rendering
+            yield metric_family
+
+
+class ExpositionCache(object):  # Text and OpenMetrics exposition of a registry, rendered and gzipped once per poll cycle and
+    # served from memory to every scraper. With a renderer thread it is rendered right after the pollers or events updated the
+    # snapshot of one of its CCUs and at the latest after Render_TTL, so the process and self instrumentation metrics stay
+    # current while the CCU backs off. Without one, e.g. /probe of the CCU in single CCU mode, it is rendered on a scrape.
+
+    def __init__(self, registry, ccus):
+        self.registry = registry
+        self.ccus = ccus
+        self.render_lock = threading.Lock()
+        self.changed = threading.Event()    # Set by refresh, wakes up the renderer thread
+        self.prerendered = False    # True while a renderer thread renders the exposition ahead of the scrapes
+        self.generations = None
+        self.rendered_timestamp = 0
+        self.bodies = {}    # (openmetrics, gzipped) -> (etag, body)
+
+    def outdated(self):     # True if the snapshot of a CCU changed since the last rendering or it is older than Render_TTL
+        return (tuple(ccu.generation for ccu in self.ccus) != self.generations or time.time() - self.rendered_timestamp >= Render_TTL)
+
+    def render(self):   # Has to be called with render_lock held, the bodies are swapped in at once so scrapes never wait
+        generations = tuple(ccu.generation for ccu in self.ccus)
+        bodies = {}
+        for openmetrics, body in ((False, generate_latest(self.registry)), (True, generate_latest_openmetrics(self.registry))):
+            etag = hashlib.sha1(body).hexdigest()[:16]
+            bodies[(openmetrics, False)] = ('"%s"' % etag, body)
+            bodies[(openmetrics, True)] = ('"%s-gzip"' % etag, gzip.compress(body, compresslevel=6))
+        self.bodies = bodies
+        self.generations = generations
+        self.rendered_timestamp = time.time()
+
+    def refresh(self):  # Signal that the snapshot of a CCU might have changed, the caller never waits for the rendering
+        self.changed.set()
+
+    def renderer(self):     # Background thread which renders whenever the snapshot of a CCU changed since the last rendering,
+        # changes during a rendering are coalesced into a single further rendering
+        self.prerendered = True
+        while True:
+            self.changed.wait(max(0, self.rendered_timestamp + Render_TTL - time.time()))
+            self.changed.clear()
+            try:
+                with self.render_lock:
+                    if self.outdated():
+                        self.render()
+            except:
+                print("Failed to render the exposition")
+                traceback.print_exc()
+
+    def get(self, openmetrics, gzipped):    # Returns (etag, body), the CCUs are polled by their state_poller and never on a scrape
+        if not self.bodies or (not self.prerendered and self.outdated()):
+            with self.render_lock:     # Concurrent scrapes wait for a single rendering
+                if not self.bodies or (not self.prerendered and self.outdated()):
+                    self.render()
+        return (self.bodies[(openmetrics, gzipped)])
+
+
+class HM2PromHandler(http.server.BaseHTTPRequestHandler):   # HTTP handler for prometheus metric exposure. /probe?target=<url>
+    # exports a single CCU in the style of the blackbox_exporter, every other path exports the default registry. The pre rendered
+    # exposition is served with ETag support, gzipped if the scraper accepts it.
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        exposition = default_exposition
+        if Debug_Endpoints and url.path == '/debug/profile':
+            cycles = urllib.parse.parse_qs(url.query).get('cycles', [''])[0]
+            if not cycle_profiler.start(int(cycles) if cycles.isdigit() else None):
+                self.send_error(409, "Profiling is already in progress")
+                return
+            body = ("Profiling the next %s poll cycles, the report is written to %s\n" % (cycle_profiler.cycles, Profile_Directory)).encode()
+            self.send_response(202)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if url.path == '/probe':
+            target = urllib.parse.parse_qs(url.query).get('target', [''])[0]
+            ccu = ccu_targets.get(normalize_ccu_url(target)) if target else None
+            if ccu is None:
+                self.send_error(404, "Unknown target %s" % target)
+                return
+            if not ccu.loaded:
+                self.send_error(503, "Target %s is not loaded yet" % target)
+                return
+            exposition = ccu.exposition
+        openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+        gzipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+        etag, body = exposition.get(openmetrics, gzipped)
+        if_none_match = self.headers.get('If-None-Match', '')
+        if etag in if_none_match or if_none_match.strip() == '*':
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE_OPENMETRICS if openmetrics else CONTENT_TYPE_LATEST)
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Vary', 'Accept, Accept-Encoding')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):   # No access log for every scrape
+        pass
+
+
+class HomematicEventHandler(object):     # XML-RPC callback methods which are called by the interface processes of the CCUs after
+    # the registration with init(). Device changes are left to the topology_refresher, so only the events are evaluated.
+
+    def event(self, interface_id, address, value_key, value):
+        ccu = event_interfaces.get(interface_id)
+        if ccu is not None and ccu.loaded:
+            ccu.apply_event(address, value_key, value)
+        return ('')
+
+    def listDevices(self, interface_id):    # The devices of the topology index, otherwise the CCU announces all devices with newDevices
+        # again on every registration
+        ccu = event_interfaces.get(interface_id)
+        if ccu is None or not ccu.loaded:
+            return ([])
+        return (ccu.list_devices())
+
+    def newDevices(self, interface_id, device_descriptions):    # Only the versions are kept for listDevices
+        ccu = event_interfaces.get(interface_id)
+        if ccu is not None:
+            for device_description in device_descriptions:
+                if 'ADDRESS' in device_description and 'VERSION' in device_description:
+                    ccu.device_versions[device_description['ADDRESS']] = device_description['VERSION']
+        return ('')
+
+    def deleteDevices(self, interface_id, addresses):
+        ccu = event_interfaces.get(interface_id)
+        if ccu is not None:
+            for address in addresses:
+                ccu.device_versions.pop(address, None)
+        return ('')
+
+    def updateDevice(self, interface_id, address, hint):
+        return ('')
+
+    def replaceDevice(self, interface_id, old_address, new_address):
+        return ('')
+
+    def readdedDevice(self, interface_id, addresses):
+        return ('')
+
+
+class HomematicEventServer(socketserver.ThreadingMixIn, xmlrpc.server.SimpleXMLRPCServer):   # Callback server for the events, the
+    # interface processes send them in system.multicall batches
+    daemon_threads = True
+
+
+
+def replay_cycles(cycles):     # Run poll cycles back to back out of Replay_Directory and print their durations and the
+    # duration of rendering the exposition. Used to profile recorded topologies without a CCU.
+    if Replay_Profile:
+        cycle_profiler.start(cycles)
+    for ccu in ccu_targets.values():
+        start = time.perf_counter()
+        ccu.load()
+        print("Loaded %s in %.3f s" % (ccu.ccu_url, time.perf_counter() - start))
+        durations = []
+        for cycle in range(cycles):
+            start = time.perf_counter()
+            ccu.next_poll = time.time()
+            ccu.refresh_snapshot()
+            render_start = time.perf_counter()
+            ccu.exposition.render()
+            durations.append(time.perf_counter() - start)
+            print("Cycle %s: %.3f s, %.3f s of it rendering" % (cycle + 1, durations[-1], time.perf_counter() - render_start))
+        print("%s cycles, %.3f s min, %.3f s avg, %.3f s max" % (cycles, min(durations), sum(durations) / cycles, max(durations)))
 
-#ToDo Get Device RSSI by address fetch rrsi data from the parent function and store them with the parent information
 
 #########################MAIN##############################################################
 
-start_http_server(HTTP_Port)    # Start prometheus HTTP server for metric exposure
-
-
-# Generate a list with all channels of all devices registered in the CCU. This chhannelist ist the base information for
-#  the upcoming querries.
-global channel_list
-channel_list=[]
-for device in devlist.iter('device'):
-    if device is not None: # Test for None addresses
-        device_ise_id = device.attrib.get("ise_id")
-        device_channels = get_channels_ise_ids(device_ise_id)
-        channel_list.extend(device_channels)
-print ("channel_list:", channel_list) #dbg might be helfull to identify consistence issues between ccu and script
-print("Number of registered channels: %s" % len(channel_list)) #dbg
-print("\n")
-
-
-#Generate a list with all system variables registered in the CCU..
-global sysvar_list
-sysvar_list=[]
-for sysvar in sysvarlist.iter('systemVariable'):
-    if sysvar is not None: # Test for None addresses
-        sysvar_ise_id = sysvar.attrib.get("ise_id")
-        sysvar_list.append(sysvar_ise_id)
-print ("sysvar_list:", sysvar_list) # dbg might be helfull to identify consistence issues between ccu and script
-print("Number of registered system variables: %s" % len(sysvar_list)) #dbg
-print("\n")
-
-
-#Generate a list with addresses for devices with RSSI radio strenght parameters.
-global rssi_list
-rssi_list=[]
-for rssi in rssilist.iter('rssi'):
-    if rssi is not None: # Test for None addresses
-        rss = sysvar.attrib.get("device")
-        rssi_list.append(sysvar_ise_id)
-print ("rssi_list:", rssi_list) # dbg might be helfull to identify consistence issues between ccu and script
-print("Number of wireless devices: %s" % len(rssi_list)) #dbg
-print("\n")
-
-
-# Iterate every n seconds over channels in channel_list and build a dictionary for each channel
-while True:
-    time.sleep(Interval)
+def main():
+    if Homematic_CCU_Targets:
+        # Probe mode: every CCU gets its own topology cache and schedule, the lists are loaded in the background so a
+        #  slow CCU does not block the others
+        for ccu_url in Homematic_CCU_Targets:
+            ccu = HomematicCCU(ccu_url)
+            ccu_targets[ccu.ccu_url] = ccu
+    else:
+        # Single CCU mode: the CCU is exported on /metrics together with the process metrics
+        ccu = HomematicCCU(Homematic_CCU_URL)
+        ccu_targets[ccu.ccu_url] = ccu
+        REGISTRY.register(HomematicCollector(ccu))
+    if Replay_Directory and Replay_Cycles:
+        replay_cycles(Replay_Cycles)
+        return
+    global default_exposition
+    default_exposition = ExpositionCache(REGISTRY, [] if Homematic_CCU_Targets else list(ccu_targets.values()))
+    # The exposition which is scraped for a CCU gets rendered ahead of the scrapes, /metrics in single CCU mode and /probe in
+    #  probe mode. /probe of the single CCU is only rendered on a scrape.
+    for exposition in [default_exposition] if default_exposition.ccus else [ccu.exposition for ccu in ccu_targets.values()]:
+        threading.Thread(target=exposition.renderer, name='renderer', daemon=True).start()
+        for ccu in exposition.ccus:
+            ccu.expositions.append(exposition)
+    if Event_Interfaces:
+        event_server = HomematicEventServer(('', Event_Port), logRequests=False, allow_none=True)
+        event_server.register_instance(HomematicEventHandler())
+        event_server.register_introspection_functions()
+        event_server.register_multicall_functions()
+        threading.Thread(target=event_server.serve_forever, name='event_server', daemon=True).start()
+    for ccu in ccu_targets.values():
+        # A CCU with a snapshot on disk is served right away, every other CCU is loaded in the background by the
+        #  topology_refresher, so a slow or unreachable CCU does not delay the start of the HTTP server
+        ccu.restore_snapshot()
+        ccu.render_expositions()
+        threading.Thread(target=ccu.topology_refresher, name='topology_refresher', daemon=True).start()
+        threading.Thread(target=ccu.state_poller, name='state_poller', daemon=True).start()
+        if Hot_Datapoints or Hot_Channels:
+            threading.Thread(target=ccu.hot_poller, name='hot_poller', daemon=True).start()
+        if Event_Interfaces:
+            threading.Thread(target=ccu.event_registrar, args=(event_server.server_address[1],), name='event_registrar', daemon=True).start()
+
+    if hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread():     # kill -USR1 <pid> profiles the next Profile_Cycles poll cycles
+        signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=cycle_profiler.start, name='cycle_profiler').start())
+
+    # The metrics are built by the HomematicCollector out of the cached samples, the states are polled from the CCU in the
+    #  background by the state_poller with an interval which adapts to the load of the CCU
+    if Event_Interfaces and threading.current_thread() is threading.main_thread():   # Unregister from the CCUs on kill <pid> as well
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    http_server = http.server.ThreadingHTTPServer(('', HTTP_Port), HM2PromHandler)  # Start HTTP server for metric exposure
+    http_server.daemon_threads = True
     try:
-        statelist = ET.fromstring(urllib.request.urlopen(Homematic_CCU_URL + CCU_statelist_URL).read())
-        sysvarlist = ET.fromstring(urllib.request.urlopen(Homematic_CCU_URL + CCU_sysvarlist_URL).read())
-
-        for channel in channel_list:  # Refetch actual states every loop
-            channel_roomname = get_rooms_for_channel(channel)
-            channel_functions = get_functions_for_channel(channel)
-            channel_parent = get_channel_parent_deviceinfo(channel)
-            channel_information = get_channel_information(channel)
-            channel_datapoints = get_datapoints_by_channel(channel)
-
-
-            try:                  
-                for datapoint in channel_datapoints:  # Has to be called for every datapoint all labels have to be provided
-                    current_datapoint=get_states_by_datapoint(datapoint)  # get the current datapoint dict
-                    if current_datapoint is not None and str(current_datapoint.get('datapoint_value')) !='':
-                        try:
-                            float(current_datapoint.get('datapoint_value') )
-                            hm2prom_states.labels(
-                            datapoint_ise_id=current_datapoint.get('datapoint_ise_id'),
-                            datapoint_name= current_datapoint.get('datapoint_name'),
-                            datapoint_type=current_datapoint.get('datapoint_type'),
-                            datapoint_value_type=current_datapoint.get('datapoint_value_type'),
-                            datapoint_value_unit=current_datapoint.get('datapoint_value_unit'),
-                            channel_iseid=channel,
-                            channel_address=channel_information.get('channel_address'),
-                            channel_name=channel_information.get('channel_name'),
-                            channel_type=channel_information.get('channel_type'),
-                            channel_parent_device=channel_information.get('channel_parent_device'),
-                            channel_direction=channel_information.get('channel_direction'),
-                            channel_rooms=channel_roomname,
-                            channel_functions=channel_functions,
-                            parent_device_ise_id=channel_parent.get('parent_device_ise_id'),
-                            parent_device_address=channel_parent.get('parent_device_address'),
-                            parent_device_name=channel_parent.get('parent_device_name'),
-                            parent_device_type=channel_parent.get('parent_device_type')).set(current_datapoint.get('datapoint_value'))
-
-                        except ValueError:
-                            print ("datapoint_value could not be converted to a float")
-                            print(current_datapoint)
-
-
-                for sysvar in sysvar_list:  # Has to be called for every sysvar all labels have to be provided
-                    current_sysvar=get_state_by_sysvar(sysvar)  # get the current sysvar dict
-                    if current_sysvar is not None and current_sysvar.get('sysvar_value') is not None:
-                        try:
-                            if isinstance(current_sysvar.get('sysvar_value'), (int,float,complex)):  # Test if value is a number
-                                hm2prom_sysvar.labels(
-                                sysvar_ise_id=current_sysvar.get('sysvar_ise_id'),
-                                sysvar_name= current_sysvar.get('sysvar_name'),
-                                sysvar_type=current_sysvar.get('sysvar_type'),
-                                sysvar_value_list=current_sysvar.get('sysvar_value_type'),
-                                sysvar_value_string="",
-                                sysvar_value_unit=current_sysvar.get('sysvar_value_unit')).set(current_sysvar.get('sysvar_value'))
-
-                            if isinstance(current_sysvar.get('sysvar_value'), (str)):  # Test if variable is a string
-                                    #print ("IS A STRING VARIABLE") #DBG
-                                    if current_sysvar.get('sysvar_value').isnumeric() :  # Test if the string contains numeric values
-                                        hm2prom_sysvar.labels(
-                                        sysvar_ise_id=current_sysvar.get('sysvar_ise_id'),
-                                        sysvar_name= current_sysvar.get('sysvar_name'),
-                                        sysvar_type=current_sysvar.get('sysvar_type'),
-                                        sysvar_value_list=current_sysvar.get('sysvar_value_type'),
-                                        sysvar_value_string="",
-                                        sysvar_value_unit=current_sysvar.get('sysvar_value_unit')).set(current_sysvar.get('sysvar_value'))
-
-                                    else:
-                                        try:
-                                            float(current_sysvar.get('sysvar_value') )
-                                            hm2prom_sysvar.labels(
-                                            sysvar_ise_id=current_sysvar.get('sysvar_ise_id'),
-                                            sysvar_name= current_sysvar.get('sysvar_name'),
-                                            sysvar_type=current_sysvar.get('sysvar_type'),
-                                            sysvar_value_list=current_sysvar.get('sysvar_value_type'),
-                                            sysvar_value_string="",
-                                            sysvar_value_unit=current_sysvar.get('sysvar_value_unit')).set(current_sysvar.get('sysvar_value'))
-                                            
-                                        except ValueError:
-                                            hm2prom_sysvar.labels(
-                                            sysvar_ise_id=current_sysvar.get('sysvar_ise_id'),
-                                            sysvar_name= current_sysvar.get('sysvar_name'),
-                                            sysvar_type=current_sysvar.get('sysvar_type'),
-                                            sysvar_value_list=current_sysvar.get('sysvar_value_type'),
-                                            sysvar_value_unit=current_sysvar.get('sysvar_value_unit'),
-                                            sysvar_value_string=current_sysvar.get('sysvar_value'))
-                                         
-                                        else:
-                                            def f():        # Python style NoOp 
-                                                pass
-                                    
-                                   
-
-                        except ValueError:  
-                            print ("sysvar_value has unexpected type:")
-                            print(current_sysvar)
-                            print ("\n") #db
-                            print ("Sysvar Value:")
-                            print (current_sysvar.get('sysvar_value') )
-                            print ("\n") #db
-                            print ("is type:", type(current_sysvar.get('sysvar_value'))) 
-                            print ("------- \n")
-                           
-
-            except:
-                print("Error in processing results")  # dbg
-                traceback.print_exc()
-    except:
-        print("XML parsing error or invalid XML received from CCU")  # Under some circumstances load? the CCU produces invalid XML output
-        traceback.print_exc()
+        http_server.serve_forever()
+    finally:
+        for ccu in ccu_targets.values():
+            ccu.unregister_events()
 
+    print ("exitpoint reached") #dbg
 
 
-print ("exitpoint reached") #dbg
+if __name__ == "__main__":
+    main()
@@ -25,6 +25,7 @@ DAEMON_DESC=$(get_lsb_header_val $0 "Short-Description")
 DAEMON_PID="/var/run/${DAEMON_NAME}.pid"
 DAEMON_NICE=0
 DAEMON_LOG='/var/log/hm2prom'
+DAEMON_STATE='/var/lib/hm2prom'    # Snapshot_Directory of hm2prom.py
 
 [ -r "/etc/default/${DAEMON_NAME}" ] && . "/etc/default/${DAEMON_NAME}"
 
@@ -40,6 +41,9 @@ do_start() {
 		touch "${DAEMON_LOG}"
 		chown $DAEMON_USER "${DAEMON_LOG}"
 		chmod u+rw "${DAEMON_LOG}"
+		mkdir -p "${DAEMON_STATE}"
+		chown $DAEMON_USER "${DAEMON_STATE}"
+		chmod 700 "${DAEMON_STATE}"
 		if [ -z "${DAEMON_USER}" ]; then
 			start-stop-daemon --start --quiet --oknodo --background \
 				--nicelevel $DAEMON_NICE \
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""hm2prom_benchmark.py: measure startup time, poll cycle latency, scrape latency and peak RSS of hm2prom against a fake CCU."""
+
+__author__      = "Markus Laber"
+__copyright__   = "Copyright 2021, Markus Laber"
+__license__ = "GPL"
+__version__ = "0.1.33"
+__email__ = "markus@relab.rocks"
+
+
+import argparse
+import math
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+from hm2prom_fakeccu import FakeCCU, start_fake_ccu
+
+
+##############DECLARATIONS#################################
+
+# Runs hm2prom in a separate process so its peak RSS can be measured, the settings are overwritten before main() is called
+EXPORTER_SCRIPT = '''
+import sys
+sys.path.insert(0, %r)
+import hm2prom
+hm2prom.Homematic_CCU_URL = %r
+hm2prom.HTTP_Port = %d
+hm2prom.Interval = %r
+hm2prom.Render_TTL = %r
+hm2prom.Compact_Labels = %r
+hm2prom.Snapshot_Directory = ''
+hm2prom.main()
+'''
+
+Interval=1  #Poll interval and Render_TTL of the benchmarked exporter
+
+
+#############FUNCTIONS#################################
+
+
+def free_port():    # Ask the OS for a free TCP port
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return (probe.getsockname()[1])
+
+
+def scrape(url):     # Scrape the exporter, returns (latency in seconds, body)
+    start = time.perf_counter()
+    with urllib.request.urlopen(url, timeout=600) as response:
+        body = response.read()
+    return ((time.perf_counter() - start, body))
+
+
+def metric_average(body, name):   # Average of a histogram of the exporter over all label sets, sum / count
+    values = {'_sum': 0, '_count': 0}
+    for line in body.decode().splitlines():
+        for suffix in values:
+            if line.startswith(name + suffix + '{'):
+                values[suffix] = values[suffix] + float(line.rsplit(' ', 1)[1])
+    return (values['_sum'] / values['_count'] if values['_count'] else float('nan'))
+
+
+def peak_rss_mb(pid):   # Peak resident set size of a process in MB, read from /proc (Linux only)
+    try:
+        with open('/proc/%d/status' % pid) as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return (int(line.split()[1]) / 1024)
+    except OSError:
+        pass
+    return (float('nan'))
+
+
+def run_benchmark(channels, cycles, channels_per_device, datapoints_per_channel, sysvars, churn, compact_labels=False):
+    fake_ccu = FakeCCU(max(1, channels // channels_per_device), channels_per_device, datapoints_per_channel, sysvars, churn=churn)
+    fake_server = start_fake_ccu(fake_ccu)
+    port = free_port()
+    metrics_url = 'http://127.0.0.1:%d/metrics' % port
+    exporter = subprocess.Popen([sys.executable, '-c', EXPORTER_SCRIPT % (os.path.dirname(os.path.abspath(__file__)),
+        'http://127.0.0.1:%d' % fake_server.server_port, port, Interval, Interval, compact_labels)], stdout=subprocess.DEVNULL)
+    try:
+        start = time.perf_counter()
+        while True:     # startup is finished as soon as the states are exported
+            if exporter.poll() is not None:
+                raise RuntimeError("hm2prom exited with %s" % exporter.returncode)
+            try:
+                if b'hm2prom_states{' in scrape(metrics_url)[1]:
+                    break
+            except OSError:
+                pass
+            time.sleep(0.05)
+        startup = time.perf_counter() - start
+
+        scrape_latencies = []
+        for cycle in range(cycles):
+            time.sleep(Interval)    # The states are polled in the background, every scrape sees a new snapshot
+            latency, body = scrape(metrics_url)
+            scrape_latencies.append(latency)
+        deadline = time.perf_counter() + 60
+        while math.isnan(metric_average(body, 'hm2prom_poll_duration_seconds')) and time.perf_counter() < deadline:
+            time.sleep(Interval)    # Large topologies take longer than Interval to render, wait for an exposition with a finished poll
+            body = scrape(metrics_url)[1]
+        return ({
+            'channels': len(fake_ccu.devices) * channels_per_device,
+            'datapoints': len(fake_ccu.datapoints),
+            'startup': startup,
+            'cycle': metric_average(body, 'hm2prom_poll_duration_seconds') + metric_average(body, 'hm2prom_update_duration_seconds'),
+            'scrape': statistics.median(scrape_latencies),
+            'rss': peak_rss_mb(exporter.pid),
+            'size': len(body) / 1024,
+        })
+    finally:
+        exporter.terminate()
+        exporter.wait()
+        fake_server.shutdown()
+
+
+#########################MAIN##############################################################
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='100,1000,10000', help='comma separated numbers of channels')
+    parser.add_argument('--cycles', type=int, default=5)
+    parser.add_argument('--channels-per-device', type=int, default=4)
+    parser.add_argument('--datapoints-per-channel', type=int, default=3)
+    parser.add_argument('--sysvars', type=int, default=50)
+    parser.add_argument('--churn', type=float, default=0.05, help='share of the values which change per poll')
+    parser.add_argument('--compact-labels', action='store_true', help='benchmark the Compact_Labels layout')
+    args = parser.parse_args()
+
+    print("%10s %10s %10s %10s %10s %10s %12s" % ('channels', 'datapoints', 'startup s', 'cycle ms', 'scrape ms', 'RSS MB', 'exposition KB'))
+    for channels in (int(size) for size in args.sizes.split(',')):
+        result = run_benchmark(channels, args.cycles, args.channels_per_device, args.datapoints_per_channel, args.sysvars, args.churn, args.compact_labels)
+        print("%10d %10d %10.2f %10.1f %10.1f %10.1f %12.0f" % (result['channels'], result['datapoints'], result['startup'],
+            result['cycle'] * 1000, result['scrape'] * 1000, result['rss'], result['size']))
+
+
+if __name__ == "__main__":
+    main()
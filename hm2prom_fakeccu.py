@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""hm2prom_fakeccu.py: synthetic stand-in for the xmlapi of a homematic CCU, used to run and benchmark hm2prom without a CCU."""
+
+__author__      = "Markus Laber"
+__copyright__   = "Copyright 2021, Markus Laber"
+__license__ = "GPL"
+__version__ = "0.1.33"
+__email__ = "markus@relab.rocks"
+
+
+import argparse
+import http.server
+import random
+import threading
+import time
+import urllib.parse
+import xmlrpc.client
+import xmlrpc.server
+from xml.sax.saxutils import quoteattr
+
+
+##############DECLARATIONS#################################
+
+# Datapoint templates of the generated channels: (type, valuetype, valueunit, value generator). Valuetypes as used by the
+#  CCU: 2 = bool, 4 = float, 16 = integer, 20 = string
+DATAPOINT_TEMPLATES = [
+    ('TEMPERATURE', '4', '°C', lambda: '%.1f' % random.uniform(15, 25)),
+    ('HUMIDITY', '16', '%', lambda: str(random.randint(30, 70))),
+    ('STATE', '2', '', lambda: random.choice(('true', 'false'))),
+    ('LOWBAT', '2', '', lambda: random.choice(('true', 'false'))),
+    ('LEVEL', '4', '100%', lambda: '%.2f' % random.random()),
+    ('POWER', '4', 'W', lambda: '%.2f' % random.uniform(0, 3000)),
+]
+
+# System variable templates: (type, subtype, valueList, unit, value generator)
+SYSVAR_TEMPLATES = [
+    ('2', '2', '', '', lambda: random.choice(('true', 'false'))),
+    ('4', '0', '', 'kWh', lambda: '%.6f' % random.uniform(0, 1000)),
+    ('16', '29', 'Off;On;Auto', '', lambda: str(random.randint(0, 2))),
+    ('20', '11', '', '', lambda: random.choice(('home', 'away', 'holiday'))),
+]
+
+# Conversion of the statelist values to the XML-RPC types of the events per valuetype
+EVENT_VALUE_TYPES = {'2': lambda value: value == 'true', '4': float, '16': int, '20': str}
+
+XML_HEADER = '<?xml version="1.0" encoding="ISO-8859-1" ?>'
+
+
+#############FUNCTIONS#################################
+
+
+class FakeCCU(object):     # Topology and states of a synthetic CCU. A configurable share of the datapoints and sysvars gets a new
+    # value and timestamp on every fetch of the statelist and sysvarlist (churn).
+
+    def __init__(self, devices=100, channels_per_device=4, datapoints_per_channel=3, sysvars=50, rooms=10, functions=5, churn=0.05, seed=1):
+        random.seed(seed)
+        self.churn = churn
+        self.lock = threading.Lock()
+        self.devices = []           # [(ise_id, name, address, [(channel ise_id, index, [datapoint ise_ids])])]
+        self.datapoints = {}        # datapoint ise_id -> [name, type, valuetype, valueunit, value, timestamp, generator]
+        self.sysvars = {}           # sysvar ise_id -> [name, type, subtype, valueList, unit, value, timestamp, generator]
+        self.rooms = {'%d' % (100 + room): ('Room %d' % room, []) for room in range(rooms)}
+        self.functions = {'%d' % (200 + function): ('Function %d' % function, []) for function in range(functions)}
+        now = int(time.time())
+        ise_id = 1000
+        for device in range(devices):
+            address = 'FAK%07d' % device
+            device_ise_id = str(ise_id)
+            ise_id = ise_id + 1
+            channels = []
+            for index in range(channels_per_device):
+                channel_ise_id = str(ise_id)
+                ise_id = ise_id + 1
+                datapoint_ise_ids = []
+                for datapoint in range(datapoints_per_channel):
+                    datapoint_type, valuetype, valueunit, generator = DATAPOINT_TEMPLATES[(index + datapoint) % len(DATAPOINT_TEMPLATES)]
+                    self.datapoints[str(ise_id)] = ['BidCos-RF.%s:%d.%s' % (address, index, datapoint_type), datapoint_type, valuetype,
+                        valueunit, generator(), now, generator]
+                    datapoint_ise_ids.append(str(ise_id))
+                    ise_id = ise_id + 1
+                channels.append((channel_ise_id, index, datapoint_ise_ids))
+                if self.rooms:
+                    self.rooms['%d' % (100 + (device % rooms))][1].append(channel_ise_id)
+                if self.functions and index % 2:
+                    self.functions['%d' % (200 + (device % functions))][1].append(channel_ise_id)
+            self.devices.append((device_ise_id, 'Fake Device %d' % device, address, channels))
+        for sysvar in range(sysvars):
+            sysvar_type, subtype, value_list, unit, generator = SYSVAR_TEMPLATES[sysvar % len(SYSVAR_TEMPLATES)]
+            self.sysvars[str(ise_id)] = ['Sysvar %d' % sysvar, sysvar_type, subtype, value_list, unit, generator(), now, generator]
+            ise_id = ise_id + 1
+
+    def churn_values(self, values, value_index):    # Give a share of the values a new value and timestamp, returns their ise_ids
+        now = int(time.time())
+        churned = random.sample(list(values), int(len(values) * self.churn))
+        for ise_id in churned:
+            values[ise_id][value_index] = values[ise_id][-1]()
+            values[ise_id][value_index + 1] = now
+        return (churned)
+
+    def churn_events(self):     # Churn the datapoints and return the changes as XML-RPC events (address, value_key, value)
+        with self.lock:
+            events = []
+            for ise_id in self.churn_values(self.datapoints, 4):
+                name, datapoint_type, valuetype, valueunit, value, timestamp, generator = self.datapoints[ise_id]
+                address, value_key = name.split('.', 1)[1].rsplit('.', 1)
+                events.append((address, value_key, EVENT_VALUE_TYPES[valuetype](value)))
+        return (events)
+
+    def devicelist(self, query):
+        xml = [XML_HEADER, '<deviceList>']
+        for device_ise_id, name, address, channels in self.devices:
+            xml.append('<device name=%s address="%s" ise_id="%s" interface="BidCos-RF" device_type="HM-FAKE" ready_config="true">'
+                % (quoteattr(name), address, device_ise_id))
+            for channel_ise_id, index, datapoints in channels:
+                xml.append('<channel name=%s type="%d" address="%s:%d" ise_id="%s" direction="%s" parent_device="%s" index="%d" '
+                    'group_partner="" aes_available="false" transmission_mode="DEFAULT" visible="true" ready_config="true" operate="true"/>'
+                    % (quoteattr('%s:%d' % (name, index)), 17 + index, address, index, channel_ise_id, 'SENDER' if index % 2 else 'RECEIVER',
+                       device_ise_id, index))
+            xml.append('</device>')
+        xml.append('</deviceList>')
+        return (xml)
+
+    def roomlist(self, query):
+        xml = [XML_HEADER, '<roomList>']
+        for room_ise_id, (name, channels) in self.rooms.items():
+            xml.append('<room name=%s ise_id="%s">' % (quoteattr(name), room_ise_id))
+            xml.extend('<channel ise_id="%s"/>' % channel for channel in channels)
+            xml.append('</room>')
+        xml.append('</roomList>')
+        return (xml)
+
+    def functionlist(self, query):
+        xml = [XML_HEADER, '<functionList>']
+        for function_ise_id, (name, channels) in self.functions.items():
+            xml.append('<function name=%s description="" ise_id="%s">' % (quoteattr(name), function_ise_id))
+            xml.extend('<channel address="" ise_id="%s"/>' % channel for channel in channels)
+            xml.append('</function>')
+        xml.append('</functionList>')
+        return (xml)
+
+    def datapoint_xml(self, ise_id):
+        name, datapoint_type, valuetype, valueunit, value, timestamp, generator = self.datapoints[ise_id]
+        return ('<datapoint name="%s" type="%s" ise_id="%s" value="%s" valuetype="%s" valueunit=%s timestamp="%d" operations="5"/>'
+            % (name, datapoint_type, ise_id, value, valuetype, quoteattr(valueunit), timestamp))
+
+    def statelist(self, query):
+        with self.lock:
+            self.churn_values(self.datapoints, 4)
+            xml = [XML_HEADER, '<stateList>']
+            for device_ise_id, name, address, channels in self.devices:
+                xml.append('<device name=%s ise_id="%s" unreach="false" config_pending="false">' % (quoteattr(name), device_ise_id))
+                for channel_ise_id, index, datapoints in channels:
+                    xml.append('<channel name=%s ise_id="%s" index="%d" visible="true" operate="true">'
+                        % (quoteattr('%s:%d' % (name, index)), channel_ise_id, index))
+                    xml.extend(self.datapoint_xml(datapoint) for datapoint in datapoints)
+                    xml.append('</channel>')
+                xml.append('</device>')
+            xml.append('</stateList>')
+        return (xml)
+
+    def state(self, query):    # Values of the requested datapoints like state.cgi?datapoint_id=<ise_id>,<ise_id> of the xmlapi,
+        # which only returns ise_id and value. The churn applies to the requested datapoints.
+        with self.lock:
+            requested = [ise_id for ise_ids in query.get('datapoint_id', []) for ise_id in ise_ids.split(',') if ise_id in self.datapoints]
+            self.churn_values({ise_id: self.datapoints[ise_id] for ise_id in requested}, 4)
+            xml = [XML_HEADER, '<state>']
+            xml.extend('<datapoint ise_id="%s" value="%s"/>' % (ise_id, self.datapoints[ise_id][4]) for ise_id in requested)
+            if not requested:
+                xml.append('<not_found/>')
+            xml.append('</state>')
+        return (xml)
+
+    def sysvarlist(self, query):
+        with self.lock:
+            self.churn_values(self.sysvars, 5)
+            xml = [XML_HEADER, '<systemVariables>']
+            for ise_id, (name, sysvar_type, subtype, value_list, unit, value, timestamp, generator) in self.sysvars.items():
+                xml.append('<systemVariable name=%s variable="%s" value="%s" valueList="%s" ise_id="%s" min="" max="" unit=%s type="%s" '
+                    'subtype="%s" logged="false" visible="true" timestamp="%d" value_name_0="" value_name_1=""/>'
+                    % (quoteattr(name), value, value, value_list, ise_id, quoteattr(unit), sysvar_type, subtype, timestamp))
+            xml.append('</systemVariables>')
+        return (xml)
+
+    def rssilist(self, query):
+        xml = [XML_HEADER, '<rssiList>']
+        xml.extend('<rssi device="%s" rx="%d" tx="%d"/>' % (address, random.randint(-100, -40), random.choice((65536, random.randint(-100, -40))))
+            for device_ise_id, name, address, channels in self.devices)
+        xml.append('</rssiList>')
+        return (xml)
+
+
+class FakeCCUHandler(http.server.BaseHTTPRequestHandler):   # Serves the xmlapi lists of the FakeCCU with keep-alive like the CCU
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        endpoint = url.path.rsplit('/', 1)[-1].split('.')[0]
+        if not url.path.startswith('/config/xmlapi/') or not hasattr(self.server.fake_ccu, endpoint):
+            self.send_error(404)
+            return
+        body = ''.join(getattr(self.server.fake_ccu, endpoint)(urllib.parse.parse_qs(url.query))).encode('iso-8859-1')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=ISO-8859-1')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_ccu(fake_ccu, port=0, address='127.0.0.1'):   # Serve a FakeCCU in a background thread, returns the server.
+    # With port 0 a free port is chosen, it is available as server.server_port.
+    server = http.server.ThreadingHTTPServer((address, port), FakeCCUHandler)
+    server.daemon_threads = True
+    server.fake_ccu = fake_ccu
+    threading.Thread(target=server.serve_forever, name='fake_ccu', daemon=True).start()
+    return (server)
+
+
+class FakeEventInterface(object):     # Stand-in for an XML-RPC interface process of the CCU like BidCos-RF on port 2001. Callback
+    # servers register with init(url, interface_id) and get the churned datapoints pushed every event_interval as system.multicall
+    # of event(interface_id, address, value_key, value), init(url) without interface_id removes the registration.
+
+    def __init__(self, fake_ccu, event_interval=1):
+        self.fake_ccu = fake_ccu
+        self.event_interval = event_interval
+        self.callbacks = {}     # callback url -> interface_id
+
+    def init(self, url, interface_id=''):
+        if interface_id:
+            self.callbacks[url] = interface_id
+        else:
+            self.callbacks.pop(url, None)
+        return ('')
+
+    def send_events(self):
+        while True:
+            time.sleep(self.event_interval)
+            events = self.fake_ccu.churn_events()
+            for url, interface_id in list(self.callbacks.items()):
+                try:
+                    multicall = xmlrpc.client.MultiCall(xmlrpc.client.ServerProxy(url))
+                    for address, value_key, value in events:
+                        multicall.event(interface_id, address, value_key, value)
+                    multicall()
+                except (OSError, xmlrpc.client.Error) as error:
+                    print("Failed to send events to %s: %s" % (url, error))
+
+
+def start_fake_event_interface(fake_ccu, port=0, address='127.0.0.1', event_interval=1):   # Serve a FakeEventInterface in a
+    # background thread and start sending events, returns the server
+    server = xmlrpc.server.SimpleXMLRPCServer((address, port), logRequests=False, allow_none=True)
+    event_interface = FakeEventInterface(fake_ccu, event_interval)
+    server.register_instance(event_interface)
+    threading.Thread(target=server.serve_forever, name='fake_event_interface', daemon=True).start()
+    threading.Thread(target=event_interface.send_events, name='fake_event_sender', daemon=True).start()
+    return (server)
+
+
+#########################MAIN##############################################################
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--channels-per-device', type=int, default=4)
+    parser.add_argument('--datapoints-per-channel', type=int, default=3)
+    parser.add_argument('--sysvars', type=int, default=50)
+    parser.add_argument('--churn', type=float, default=0.05, help='share of the values which change per fetch')
+    parser.add_argument('--event-port', type=int, help='serve a XML-RPC interface process which pushes events on this port, e.g. 2001')
+    parser.add_argument('--event-interval', type=float, default=1, help='seconds between the pushed event batches')
+    args = parser.parse_args()
+    fake_ccu = FakeCCU(args.devices, args.channels_per_device, args.datapoints_per_channel, args.sysvars, churn=args.churn)
+    server = start_fake_ccu(fake_ccu, args.port, args.address)
+    print("Fake CCU with %s devices and %s datapoints on http://%s:%s" % (len(fake_ccu.devices), len(fake_ccu.datapoints), args.address, server.server_port))
+    if args.event_port is not None:
+        event_server = start_fake_event_interface(fake_ccu, args.event_port, args.address, args.event_interval)
+        print("Fake XML-RPC interface process on port %s" % event_server.server_address[1])
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == "__main__":
+    main()